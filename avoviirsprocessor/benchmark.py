@@ -0,0 +1,465 @@
+"""
+Benchmark product generation with synthetic VIIRS data.
+
+Builds SDR-like swaths along a realistic ground track over Alaska, then runs
+each processor through processor_factory, load_data, find_sectors,
+plan_renders, and render with the volcview and ZMQ sinks stubbed out.
+As in production, composites are generated for each sector and products
+are skipped for sectors they do not cover. Finding sectors needs orbital
+elements, from the network or TLES. Wall time, peak RSS,
+and per-stage timings are reported for each product and sector count, along
+with the time taken to import each entry point in a fresh interpreter.
+Results can be saved as JSON and compared against an earlier run.
+
+"""
+
+import argparse
+import json
+import multiprocessing
+import resource
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import dask.array as da
+import xarray as xr
+from posttroll.message import Message
+from pyresample.geometry import SwathDefinition
+from satpy.dataset.dataid import DataID, default_id_keys_config
+from satpy.scene import Scene
+from avoviirsprocessor import logger
+from avoviirsprocessor import runtime
+from avoviirsprocessor.metrics import metrics
+from avoviirsprocessor.processor import Processor, plan_renders, processor_factory
+from avoviirsprocessor.sectors import get_sector_index
+import avoviirsprocessor.coreprocessors  # NOQA
+
+EARTH_RADIUS = 6371.0  # km
+GRANULE_ROWS = 1536  # I-band rows in an 86 second granule
+GRANULE_SECONDS = 86
+GRANULE_KM = 570
+SWATH_COLS = 6400
+SWATH_KM = 3040
+TRACK_START = (70.0, -140.0)  # lat, lon
+TRACK_HEADING = 205.0  # degrees, descending toward the Aleutians
+PLATFORM = "NOAA-20"
+CHUNK_SIZE = 1024
+TRUE_COLOR_BANDS = ("M05", "M04", "M03")  # red, green, blue
+TRUE_COLOR_MODIFIERS = ("sunz_corrected", "rayleigh_corrected")
+ENTRY_POINTS = (
+    "watcher",
+    "avoviirsprocessor.healthcheck",
+    "avoviirsprocessor.process_message",
+)
+
+
+def _destination(lats, lons, bearing, distance):
+    lats, lons, bearing = np.radians(lats), np.radians(lons), np.radians(bearing)
+    delta = distance / EARTH_RADIUS
+    lat2 = np.arcsin(
+        np.sin(lats) * np.cos(delta) + np.cos(lats) * np.sin(delta) * np.cos(bearing)
+    )
+    lon2 = lons + np.arctan2(
+        np.sin(bearing) * np.sin(delta) * np.cos(lats),
+        np.cos(delta) - np.sin(lats) * np.sin(lat2),
+    )
+    return np.degrees(lat2), (np.degrees(lon2) + 180) % 360 - 180
+
+
+def _bearing(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    y = np.sin(lon2 - lon1) * np.cos(lat2)
+    x = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return np.degrees(np.arctan2(y, x))
+
+
+def synthetic_swath(granules, scale, resolution_factor=1):
+    """Create swath geolocation along a VIIRS-like ground track.
+
+    Parameters
+    ----------
+    granules : int
+        Number of granules in the pass.
+    scale : float
+        Fraction of the true pixel count along each dimension.
+    resolution_factor : int, optional
+        1 for I-bands, 2 for M-bands.
+
+    Returns
+    -------
+    pyresample.geometry.SwathDefinition
+    """
+    rows = int(granules * GRANULE_ROWS * scale / resolution_factor)
+    cols = int(SWATH_COLS * scale / resolution_factor)
+    along = np.linspace(0, granules * GRANULE_KM, rows)
+    center_lats, center_lons = _destination(
+        TRACK_START[0], TRACK_START[1], TRACK_HEADING, along
+    )
+    heading = _bearing(
+        center_lats[:-1], center_lons[:-1], center_lats[1:], center_lons[1:]
+    )
+    heading = np.append(heading, heading[-1])
+    cross = np.linspace(-SWATH_KM / 2, SWATH_KM / 2, cols)
+    lats, lons = _destination(
+        center_lats[:, np.newaxis],
+        center_lons[:, np.newaxis],
+        heading[:, np.newaxis] + 90,
+        cross[np.newaxis, :],
+    )
+    lons = xr.DataArray(da.from_array(lons, chunks=CHUNK_SIZE), dims=("y", "x"))
+    lats = xr.DataArray(da.from_array(lats, chunks=CHUNK_SIZE), dims=("y", "x"))
+    lons.attrs["resolution"] = 375 * resolution_factor / scale
+    return SwathDefinition(lons, lats)
+
+
+def _brightness_temperature(shape, mean, seed):
+    rng = np.random.default_rng(seed)
+    rows, cols = np.indices(shape, dtype=np.float32)
+    field = mean + 20 * np.sin(rows / 97.0) * np.cos(cols / 131.0)
+    field += rng.normal(0, 2, shape).astype(np.float32)
+    return field.astype(np.float32)
+
+
+def _dataset(data, dims, name, area, start_time, end_time, **attrs):
+    attrs.update(
+        {
+            "name": name,
+            "area": area,
+            "start_time": start_time,
+            "end_time": end_time,
+            "platform_name": PLATFORM,
+            "sensor": "viirs",
+        }
+    )
+    return xr.DataArray(da.from_array(data, chunks=CHUNK_SIZE), dims=dims, attrs=attrs)
+
+
+class SyntheticScene(Scene):
+    """A scene holding synthetic data, which loads nothing from disk
+
+    Composites are built from the synthetic datasets, as if they had been
+    read.
+    """
+
+    def load(self, wishlist, *args, **kwargs):
+        missing = [name for name in wishlist if name not in self]
+        if missing:
+            super().load(missing, *args, **kwargs)
+
+    def add_input(self, key, dataset):
+        """Add a dataset as though a reader had loaded it as a prerequisite.
+
+        Parameters
+        ----------
+        key : string or satpy.dataset.DataID
+        dataset : xarray.DataArray
+        """
+        self[key] = dataset
+        # datasets set directly are wished for, ones loaded for a composite
+        # are not, and only those are resampled to generate the composite
+        self._wishlist.discard(self._datasets.get_key(key))
+
+    @property
+    def start_time(self):
+        return min(self[name].attrs["start_time"] for name in self.keys())
+
+    @property
+    def end_time(self):
+        return max(self[name].attrs["end_time"] for name in self.keys())
+
+
+def synthetic_scene(granules, scale, start_time):
+    """Create a scene with I04, I05, M15, M16 and true_color inputs.
+
+    The true_color inputs are reflectances which have already been
+    corrected, so generating true_color needs neither angles nor pyspectral.
+
+    Parameters
+    ----------
+    granules : int
+        Number of granules in the pass.
+    scale : float
+        Fraction of the true pixel count along each dimension.
+    start_time : datetime.datetime
+
+    Returns
+    -------
+    SyntheticScene
+    """
+    end_time = start_time + timedelta(seconds=granules * GRANULE_SECONDS)
+    i_area = synthetic_swath(granules, scale)
+    m_area = synthetic_swath(granules, scale, resolution_factor=2)
+    scene = SyntheticScene()
+    times = (start_time, end_time)
+    i_shape = i_area.shape
+    m_shape = m_area.shape
+    dims = ("y", "x")
+    units = {"units": "K", "standard_name": "toa_brightness_temperature"}
+    scene["I04"] = _dataset(
+        _brightness_temperature(i_shape, 280, 4), dims, "I04", i_area, *times, **units
+    )
+    scene["I05"] = _dataset(
+        _brightness_temperature(i_shape, 255, 5), dims, "I05", i_area, *times, **units
+    )
+    scene["M15"] = _dataset(
+        _brightness_temperature(m_shape, 255, 15), dims, "M15", m_area, *times, **units
+    )
+    scene["M16"] = _dataset(
+        _brightness_temperature(m_shape, 254, 16), dims, "M16", m_area, *times, **units
+    )
+    rng = np.random.default_rng(0)
+    for name in TRUE_COLOR_BANDS:
+        reflectance = rng.uniform(0, 100, m_shape).astype(np.float32)
+        key = DataID(
+            default_id_keys_config,
+            name=name,
+            resolution=750,
+            calibration="reflectance",
+            modifiers=TRUE_COLOR_MODIFIERS,
+        )
+        attrs = dict(key.to_dict(), units="%")
+        del attrs["name"]
+        scene.add_input(key, _dataset(reflectance, dims, name, m_area, *times, **attrs))
+    return scene
+
+
+def synthetic_message(product, start_time, end_time):
+    """Create a message like those sent by the task server.
+
+    Parameters
+    ----------
+    product : string
+    start_time, end_time : datetime.datetime
+
+    Returns
+    -------
+    posttroll.message.Message
+    """
+    data = {
+        "platform_name": PLATFORM,
+        "start_time": start_time,
+        "end_time": end_time,
+        "orbit_number": 1,
+        "sensor": ["viirs"],
+    }
+    return Message("/pytroll/viirs/{}".format(product), "info", data)
+
+
+class _StubNotifier(object):
+    def notify(self, *args, **kwargs):
+        pass
+
+    def flush(self):
+        return 0
+
+
+class _StubRuntime(object):
+    notifier = _StubNotifier()
+
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_case(product, sector_count, granules, scale):
+    """Benchmark one product for some number of sectors.
+
+    Parameters
+    ----------
+    product : string
+    sector_count : int
+        Number of sectors to render.
+    granules : int
+        Number of granules in the pass.
+    scale : float
+        Fraction of the true pixel count along each dimension.
+
+    Returns
+    -------
+    dict
+        Results for the case.
+    """
+    runtime._runtime = _StubRuntime()
+    metrics.reset()
+    start_time = datetime(2019, 6, 1, 21, 30)
+    scene = synthetic_scene(granules, scale, start_time)
+    message = synthetic_message(product, scene.start_time, scene.end_time)
+
+    start = time.perf_counter()
+    processor = processor_factory(message, scene=scene)
+    with metrics.timer("load_data", product=product):
+        processor.load_data()
+    with metrics.timer("find_sectors", product=product):
+        sectors = processor.find_sectors()
+    if len(sectors) < sector_count:
+        sectors += [s for s in get_sector_index().sectors if s not in sectors]
+    sectors = sectors[:sector_count]
+    jobs = plan_renders([processor], sectors)
+    for sector_def, _ in jobs:
+        processor.render(sector_def)
+    wall_time = time.perf_counter() - start
+
+    return {
+        "product": product,
+        "sectors": len(sectors),
+        "rendered": len(jobs),
+        "granules": granules,
+        "scale": scale,
+        "wall_time": wall_time,
+        "peak_rss": _peak_rss(),
+        "stages": metrics.snapshot(),
+    }
+
+
+def _run_case(args):
+    return run_case(*args)
+
+
+def import_time(module):
+    """Time importing a module in a fresh interpreter.
+
+    Parameters
+    ----------
+    module : string
+        Module name, importable from the current directory.
+
+    Returns
+    -------
+    dict
+        Result for the entry point, or None if it cannot be imported.
+    """
+    code = (
+        "import importlib, time; start = time.perf_counter(); "
+        "importlib.import_module({!r}); print(time.perf_counter() - start)"
+    ).format(module)
+    process = subprocess.run(
+        [sys.executable, "-c", code], stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    if process.returncode != 0:
+        logger.error("Cannot import %s: %s", module, process.stderr.decode())
+        return None
+    return {"entry_point": module, "wall_time": float(process.stdout.split()[-1])}
+
+
+def _key(result):
+    if "entry_point" in result:
+        return ("import", result["entry_point"])
+    return (result["product"], result["sectors"])
+
+
+def _label(key):
+    if key[0] == "import":
+        return "import {}".format(key[1])
+    return "{:>4} {:>3} sectors".format(*key)
+
+
+def compare(results, baseline):
+    """Print the change in wall time from a baseline run.
+
+    Parameters
+    ----------
+    results, baseline : list of dict
+        Results of run_case and import_time.
+    """
+    previous = {_key(b): b for b in baseline}
+    for result in results:
+        key = _key(result)
+        if key not in previous:
+            continue
+        ratio = result["wall_time"] / previous[key]["wall_time"]
+        flag = "  REGRESSION" if ratio > 1.1 else ""
+        print(
+            "{}: {:8.3f}s vs {:8.3f}s ({:+.1%}){}".format(
+                _label(key),
+                result["wall_time"],
+                previous[key]["wall_time"],
+                ratio - 1,
+                flag,
+            )
+        )
+
+
+def _stage_totals(result):
+    totals = {}
+    for stage in result["stages"]:
+        totals[stage["stage"]] = totals.get(stage["stage"], 0) + stage["seconds"]
+    return totals
+
+
+def _arg_parse():
+    description = "Benchmark product generation with synthetic VIIRS data."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--products",
+        default=",".join(p.Product for p in Processor.__subclasses__()),
+        help="comma-separated products to benchmark",
+    )
+    parser.add_argument(
+        "--sector-counts", default="1,5", help="comma-separated sector counts"
+    )
+    parser.add_argument("--granules", type=int, default=4, help="granules per pass")
+    parser.add_argument(
+        "--scale", type=float, default=0.25, help="fraction of full resolution"
+    )
+    parser.add_argument(
+        "--entry-points",
+        default=",".join(ENTRY_POINTS),
+        help="comma-separated modules to time importing, or empty for none",
+    )
+    parser.add_argument("--output", help="save results as JSON")
+    parser.add_argument("--baseline", help="JSON results to compare against")
+
+    return parser.parse_args()
+
+
+def main():
+    args = _arg_parse()
+    cases = [
+        (product, int(count), args.granules, args.scale)
+        for product in args.products.split(",")
+        for count in args.sector_counts.split(",")
+    ]
+
+    # run each case in a fresh process so peak RSS is per case
+    context = multiprocessing.get_context("fork")
+    results = []
+    for case in cases:
+        with context.Pool(1) as pool:
+            result = pool.apply(_run_case, (case,))
+        results.append(result)
+        stages = ", ".join(
+            "{} {:.3f}s".format(stage, seconds)
+            for stage, seconds in sorted(_stage_totals(result).items())
+        )
+        print(
+            "{:>4} {:>3} sectors, {:>3} rendered: {:8.3f}s, "
+            "peak RSS {:6.0f} MiB ({})".format(
+                result["product"],
+                result["sectors"],
+                result["rendered"],
+                result["wall_time"],
+                result["peak_rss"] / 2 ** 20,
+                stages,
+            )
+        )
+
+    for module in filter(None, args.entry_points.split(",")):
+        result = import_time(module)
+        if result is not None:
+            results.append(result)
+            print("{}: {:8.3f}s".format(_label(_key(result)), result["wall_time"]))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, default=str)
+
+
+if __name__ == "__main__":
+    main()
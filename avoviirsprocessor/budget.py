@@ -0,0 +1,153 @@
+"""
+Keep each task within a memory budget.
+
+When MEMORY_BUDGET is set, dask's thread count and chunk size are chosen so
+the chunks being worked on at once fit in the budget, and SDR granules which
+cannot reach any covered sector are dropped before the scene is created. A
+long pass then costs no more memory than the granules over our sectors.
+
+Each entry point applies the budget by calling configure() when it starts.
+Older satpy reads PYTROLL_CHUNK_SIZE when it is imported, so configure() is
+called before satpy is imported; see launcher for the console scripts.
+
+"""
+
+import os
+
+import dask
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor.catalog import parse_filename
+
+MEMORY_BUDGET = int(tutil.get_env_var("MEMORY_BUDGET", 0))  # MiB, 0 disables
+THREAD_MEMORY = 512  # MiB, least memory worth giving a dask thread
+CHUNK_COPIES = 12  # float64 arrays per chunk in flight: data, lons, lats, indices
+MIN_CHUNK_SIZE = 256
+MAX_CHUNK_SIZE = 4096
+
+
+def worker_threads(budget=MEMORY_BUDGET):
+    """Choose the number of dask threads for a budget.
+
+    Parameters
+    ----------
+    budget : int, optional
+        Memory budget in MiB.
+
+    Returns
+    -------
+    int
+    """
+    threads = os.cpu_count() or 1
+    return max(1, min(threads, budget // THREAD_MEMORY))
+
+
+def chunk_size(budget=MEMORY_BUDGET, threads=None):
+    """Choose the edge length of square dask chunks for a budget.
+
+    Parameters
+    ----------
+    budget : int, optional
+        Memory budget in MiB.
+    threads : int, optional
+        Number of dask threads sharing the budget.
+
+    Returns
+    -------
+    int
+        Chunk edge length in pixels, a multiple of MIN_CHUNK_SIZE.
+    """
+    if threads is None:
+        threads = worker_threads(budget)
+    per_chunk = budget * 2 ** 20 / (threads * CHUNK_COPIES * 8)
+    size = int(per_chunk ** 0.5) // MIN_CHUNK_SIZE * MIN_CHUNK_SIZE
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, size))
+
+
+def configure(budget=MEMORY_BUDGET):
+    """Apply a memory budget to dask and satpy.
+
+    Parameters
+    ----------
+    budget : int, optional
+        Memory budget in MiB. Nothing is changed if zero.
+    """
+    if not budget:
+        return
+
+    threads = worker_threads(budget)
+    size = chunk_size(budget, threads)
+    os.environ["PYTROLL_CHUNK_SIZE"] = str(size)
+    chunk_bytes = "{}MiB".format(max(1, size ** 2 * 8 >> 20))
+    dask.config.set({"num_workers": threads, "array.chunk-size": chunk_bytes})
+    logger.info(
+        "Memory budget %d MiB: %d dask threads, %d pixel chunks", budget, threads, size
+    )
+
+
+def granule_times(filename):
+    """Read the time span of an SDR granule from its filename.
+
+    Parameters
+    ----------
+    filename : string
+
+    Returns
+    -------
+    tuple
+        start and end time, or None if the filename is not recognized.
+    """
+    parsed = parse_filename(filename)
+    if parsed is None:
+        return None
+    platform, start_time, end_time = parsed
+    return start_time, end_time
+
+
+def trim_granules(platform_name, filenames, sectors):
+    """Drop granules which cannot reach any of the given sectors.
+
+    Files which are not recognized as granules are kept.
+
+    Parameters
+    ----------
+    platform_name : string
+    filenames : list of string
+        SDR and geolocation files.
+    sectors : list of pyresample.geometry.AreaDefinition
+        Sectors to be produced.
+
+    Returns
+    -------
+    list
+        Files belonging to granules within reach of a sector.
+    """
+    from trollsched.satpass import Pass
+    from avoviirsprocessor.sectors import TRACK_REACH, get_sector_index, ground_track
+
+    granules = {}
+    for filename in filenames:
+        granules.setdefault(granule_times(filename), []).append(filename)
+    spans = [span for span in granules if span is not None]
+    if not spans:
+        return list(filenames)
+
+    wanted = set(sector_def.area_id for sector_def in sectors)
+    overpass = Pass(
+        platform_name,
+        min(start for start, end in spans),
+        max(end for start, end in spans),
+        instrument="viirs",
+    )
+    index = get_sector_index()
+    kept = list(granules.get(None, []))
+    for start_time, end_time in sorted(spans):
+        lons, lats = ground_track(overpass, start_time, end_time)
+        near = index.candidates(lons, lats, TRACK_REACH)
+        if wanted.intersection(sector_def.area_id for sector_def in near):
+            kept += granules[(start_time, end_time)]
+        else:
+            logger.debug("Skipping granule %s - %s", start_time, end_time)
+
+    logger.info("Kept %d of %d granule files", len(kept), len(filenames))
+    return kept
@@ -0,0 +1,204 @@
+"""
+Find SDR files without walking the SDR directory for every task.
+
+The catalog parses each SDR filename once and keeps the files of each
+platform sorted by start time, so a platform and time window query is a
+binary search. Every query checks the modification time of the directory,
+and the directory is rescanned only when that shows files were added or
+removed; only new filenames are parsed. Health checks, which only need the
+newest file, check the directory at most every CATALOG_REFRESH seconds.
+
+"""
+
+import os
+import re
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta
+
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+
+SDR_DIR = "/viirs/sdr"
+CATALOG_REFRESH = float(tutil.get_env_var("CATALOG_REFRESH", 10))
+PLATFORMS = {"npp": "Suomi-NPP", "j01": "NOAA-20", "j02": "NOAA-21"}
+FILE_PATTERN = re.compile(
+    r"^[A-Z0-9-]+_(?P<platform>[a-z0-9]+)_d(?P<day>\d{8})_t(?P<start>\d{7})"
+    r"_e(?P<end>\d{7})_b\d+_c\d+_\w+\.h5$"
+)
+
+
+def _parse_time(day, time_of_day):
+    # filenames give times to a tenth of a second
+    parsed = datetime.strptime(day + time_of_day[:6], "%Y%m%d%H%M%S")
+    return parsed + timedelta(microseconds=int(time_of_day[6]) * 100000)
+
+
+def parse_filename(filename):
+    """Read the platform and time span from an SDR filename.
+
+    Parameters
+    ----------
+    filename : string
+
+    Returns
+    -------
+    tuple
+        platform name, start time, and end time, or None if the filename is
+        not recognized.
+    """
+    match = FILE_PATTERN.match(os.path.basename(filename))
+    if match is None:
+        return None
+    platform = PLATFORMS.get(match.group("platform"), match.group("platform"))
+    day = match.group("day")
+    start_time = _parse_time(day, match.group("start"))
+    end_time = _parse_time(day, match.group("end"))
+    if end_time < start_time:
+        end_time += timedelta(days=1)
+    return platform, start_time, end_time
+
+
+class SdrCatalog(object):
+    """Index of SDR files by platform and time
+
+    Parameters
+    ----------
+    base_dir : string
+        Directory holding SDR files.
+    refresh : float, optional
+        Minimum seconds between directory checks made by newest().
+    """
+
+    def __init__(self, base_dir, refresh=CATALOG_REFRESH):
+        self.base_dir = base_dir
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        self._files = {}
+        self._index = {}
+        self._dir_mtime = None
+        self._scanned_at = 0
+
+    def __len__(self):
+        return len(self._files)
+
+    def scan(self, force=False):
+        """Bring the catalog up to date with the directory.
+
+        Parameters
+        ----------
+        force : bool, optional
+            Scan even if the directory appears unchanged.
+        """
+        with self._lock:
+            self._scanned_at = time.time()
+            try:
+                dir_mtime = os.stat(self.base_dir).st_mtime
+            except OSError:
+                logger.exception("Cannot read %s", self.base_dir)
+                return
+            if not force and dir_mtime == self._dir_mtime:
+                return
+            self._dir_mtime = dir_mtime
+
+            start = time.time()
+            with os.scandir(self.base_dir) as entries:
+                names = set(entry.name for entry in entries)
+            known = set(self._files)
+            for name in known - names:
+                del self._files[name]
+            for name in names - known:
+                self._files[name] = parse_filename(name)
+            self._build_index()
+            logger.debug(
+                "Catalog of %d files updated in %.3f seconds",
+                len(self._files),
+                time.time() - start,
+            )
+
+    def _build_index(self):
+        index = {}
+        for name, parsed in self._files.items():
+            if parsed is not None:
+                platform, start_time, end_time = parsed
+                index.setdefault(platform, []).append((start_time, end_time, name))
+
+        self._index = {}
+        for platform, granules in index.items():
+            granules.sort()
+            longest = max(end - start for start, end, name in granules)
+            starts = [start for start, end, name in granules]
+            self._index[platform] = (starts, granules, longest)
+
+    def find_files(self, platform_name, start_time, end_time):
+        """Find files overlapping a time window.
+
+        Parameters
+        ----------
+        platform_name : string
+        start_time, end_time : datetime.datetime
+
+        Returns
+        -------
+        list
+            Paths of matching files, ordered by start time.
+        """
+        self.scan()
+        with self._lock:
+            if platform_name not in self._index:
+                return []
+            starts, granules, longest = self._index[platform_name]
+            first = bisect_left(starts, start_time - longest)
+            last = bisect_right(starts, end_time)
+            return [
+                os.path.join(self.base_dir, name)
+                for start, end, name in granules[first:last]
+                if end >= start_time
+            ]
+
+    def newest(self):
+        """Return the end time of the newest file, or None if there are none."""
+        if time.time() - self._scanned_at >= self.refresh:
+            self.scan()
+        with self._lock:
+            ends = [
+                max(end for start, end, name in granules)
+                for starts, granules, longest in self._index.values()
+            ]
+        return max(ends) if ends else None
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    """Return the catalog of SDR_DIR shared by this process.
+
+    Returns
+    -------
+    catalog.SdrCatalog
+    """
+    global _catalog
+
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = SdrCatalog(SDR_DIR)
+    return _catalog
+
+
+def find_files(platform_name, start_time, end_time):
+    """Find SDR files overlapping a time window using the shared catalog.
+
+    Parameters
+    ----------
+    platform_name : string
+    start_time, end_time : datetime.datetime
+
+    Returns
+    -------
+    list
+        Paths of matching files, ordered by start time.
+    """
+    return get_catalog().find_files(platform_name, start_time, end_time)
@@ -1,64 +1,81 @@
-from avoviirsprocessor.processor import Processor, TYPEFACE
+import copy
+
+import numpy as np
+from avoviirsprocessor.processor import Processor
+from avoviirsprocessor.decorations import get_font
+from avoviirsprocessor.enhancements import LookupTable
+from avoviirsprocessor.resampling import SceneResampler, resample
+from avoviirsprocessor.sectors import min_sun_zenith
 from trollimage import colormap
 from satpy.dataset import combine_metadata
-import aggdraw
 from satpy.enhancements import cira_stretch
+import tomputils.util as tutil
+
+MAX_SUN_ZENITH = float(tutil.get_env_var("MAX_SUN_ZENITH", 90))
 
 
 class TIR(Processor):
     Product = "tir"
+    Bands = ["I05"]
 
-    def __init__(self, message):
+    def __init__(self, message, scene=None):
         super().__init__(
             message,
             TIR.Product,
             "Thermal IR",
             "thermal infrared brightness tempeerature (c)",
+            scene=scene,
         )
-
-    def enhance_image(self, img):
-        img.crude_stretch(208.15, 308.15)  # -65c - 35c
-        img.invert()
+        # white to black, matching the inverted lookup table
+        self.colors = copy.deepcopy(colormap.greys)
+        self.colors.set_range(-65, 35)
+        self.lookup_table = LookupTable(208.15, 308.15, invert=True)  # -65c - 35c
 
     def apply_colorbar(self, dcimg):
-        colors = colormap.greys
-        colors.set_range(-65, 35)
-        super().draw_colorbar(dcimg, colors, 20, 10)
+        super().draw_colorbar(dcimg, self.colors, 20, 10)
 
     def load_data(self):
-        self.scene.load(["I05"])
+        self.scene.load(TIR.Bands)
         self.scene["tir"] = self.scene["I05"]
 
 
 class MIR(Processor):
     Product = "mir"
+    Bands = ["I04"]
 
-    def __init__(self, message):
+    def __init__(self, message, scene=None):
         super().__init__(
-            message, MIR.Product, "Mid-IR", "mid-infrared brightness temperature (c)"
+            message,
+            MIR.Product,
+            "Mid-IR",
+            "mid-infrared brightness temperature (c)",
+            scene=scene,
         )
         self.colors = colormap.Colormap((0.0, (0.0, 0.0, 0.0)), (1.0, (1.0, 1.0, 1.0)))
         self.colors.set_range(-50, 50)
-
-    def enhance_image(self, img):
-        img.crude_stretch(223.15, 323.15)  # -50c - 50c
+        self.lookup_table = LookupTable(223.15, 323.15)  # -50c - 50c
 
     def apply_colorbar(self, dcimg):
         super().draw_colorbar(dcimg, self.colors, 20, 10)
 
     def load_data(self):
-        self.scene.load(["I04"])
+        self.scene.load(MIR.Bands)
         self.scene["mir"] = self.scene["I04"]
 
 
 class BTD(Processor):
     Product = "btd"
+    Bands = ["M15", "M16"]
 
-    def __init__(self, message):
+    def __init__(self, message, scene=None):
         super().__init__(
-            message, BTD.Product, "TIR BTD", "brightness temperature difference"
+            message,
+            BTD.Product,
+            "TIR BTD",
+            "brightness temperature difference",
+            scene=scene,
         )
-        self.color_bar_font = aggdraw.Font((0, 0, 0), TYPEFACE, size=14)
+        self.color_bar_font = get_font((0, 0, 0), 14)
         self.colors = colormap.Colormap(
             (0.0, (0.5, 0.0, 0.0)),
             (0.071428, (1.0, 0.0, 0.0)),
@@ -72,29 +89,60 @@ class BTD(Processor):
             (1.0, (1.0, 1.0, 1.0)),
         )
         self.colors.set_range(-6, 5)
-
-    def enhance_image(self, img):
-        img.colorize(self.colors)
+        self.lookup_table = LookupTable(-6, 5, colors=self.colors)
 
     def apply_colorbar(self, dcimg):
         super().draw_colorbar(dcimg, self.colors, 1, 0.5)
 
     def load_data(self):
-        self.scene.load(["M15", "M16"])
-        self.scene["btd"] = self.scene["M15"] - self.scene["M16"]
-        self.scene["btd"].attrs = combine_metadata(self.scene["M15"], self.scene["M16"])
+        self.scene.load(BTD.Bands)
+        m15 = self.scene["M15"]
+        m16 = self.scene["M16"]
+        btd = m15.astype(np.float32, copy=False) - m16.astype(np.float32, copy=False)
+        btd.attrs = combine_metadata(m15.attrs, m16.attrs)
+        self.scene["btd"] = btd
 
 
 class VIS(Processor):
     Product = "vis"
+    Bands = ["true_color"]
 
-    def __init__(self, message):
-        super().__init__(message, VIS.Product, "Visible", "true color")
+    def __init__(self, message, scene=None):
+        super().__init__(message, VIS.Product, "Visible", "true color", scene=scene)
 
     def enhance_image(self, img):
         cira_stretch(img)
 
+    def covers(self, sector_def):
+        pass_times = (self.data["start_time"], self.data["end_time"])
+        return min_sun_zenith(sector_def, pass_times) < MAX_SUN_ZENITH
+
     def load_data(self):
-        self.scene.load(["true_color"])
-        self.scene = self.scene.resample(resampler="native")
-        self.scene["vis"] = self.scene["true_color"]
+        # only the bands and angles; true_color is generated for each sector
+        self.scene.load(VIS.Bands, generate=False)
+
+    def _swath_inputs(self):
+        # true_color if it was already generated on the swath, otherwise
+        # every dataset loaded only as a prerequisite of a composite. The
+        # wishlist holds queries, not DataIDs, so compare by name; a shared
+        # scene also holds the bands other products asked for.
+        if "true_color" in self.scene:
+            return ["true_color"]
+        wished = set(query.get("name") for query in self.scene.wishlist)
+        return [ds_id for ds_id in self.scene.keys() if ds_id["name"] not in wished]
+
+    def persist_data(self):
+        for ds_id in self._swath_inputs():
+            dataset = self.scene[ds_id]
+            dataset.data = dataset.data.persist()
+
+    def resample_sector(self, sector_def):
+        if "true_color" in self.scene:
+            return resample(self.scene["true_color"], sector_def)
+        local_scene = self.scene.resample(
+            sector_def,
+            datasets=self._swath_inputs(),
+            resampler=SceneResampler,
+            reduce_data=False,
+        )
+        return local_scene["true_color"]
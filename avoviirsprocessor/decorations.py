@@ -0,0 +1,91 @@
+"""
+Decorate volcview images.
+
+Colorbars depend only on the product, image size, and colormap, so each is
+rendered once into a transparent strip and pasted onto later images. Fonts
+are likewise built once and shared.
+
+"""
+
+import functools
+
+import aggdraw
+import numpy as np
+from PIL import Image
+from pydecorate import DecoratorAGG
+
+GOLDENROD = (218, 165, 32)
+TYPEFACE = "/app/avoviirsprocessor/Cousine-Bold.ttf"
+FONT_SIZE = 14
+
+_colorbars = {}
+
+
+@functools.lru_cache(maxsize=None)
+def get_font(color, size=FONT_SIZE):
+    """Return a shared aggdraw font.
+
+    Parameters
+    ----------
+    color : tuple
+        RGB font color.
+    size : int, optional
+        Font size.
+
+    Returns
+    -------
+    aggdraw.Font
+    """
+    return aggdraw.Font(color, TYPEFACE, size=size)
+
+
+def colormap_key(colors):
+    """Identify a colormap by its stops and colors.
+
+    Parameters
+    ----------
+    colors : trollimage.colormap.Colormap or None
+
+    Returns
+    -------
+    tuple
+    """
+    if colors is None:
+        return None
+    return (
+        tuple(np.asarray(colors.values).tolist()),
+        np.asarray(colors.colors).tobytes(),
+    )
+
+
+def get_colorbar(key, size, draw):
+    """Retrieve a colorbar strip, rendering it if needed.
+
+    Parameters
+    ----------
+    key : tuple
+        Identifies the product, image size, and colormap.
+    size : tuple
+        Width and height of the image to be decorated.
+    draw : callable
+        Called with a bottom-aligned pydecorate.DecoratorAGG to draw the
+        colorbar.
+
+    Returns
+    -------
+    PIL.Image
+        RGBA strip spanning the bottom of the image, or None if nothing was
+        drawn.
+    """
+    if key not in _colorbars:
+        layer = Image.new("RGBA", size, (0, 0, 0, 0))
+        dc = DecoratorAGG(layer)
+        dc.align_bottom()
+        draw(dc)
+        bbox = layer.getchannel("A").getbbox()
+        if bbox is None:
+            _colorbars[key] = None
+        else:
+            _colorbars[key] = layer.crop((0, bbox[1], size[0], size[1]))
+
+    return _colorbars[key]
@@ -0,0 +1,69 @@
+"""
+Enhance single-band products through lookup tables.
+
+A stretch, inversion, or colormap over a fixed range of data values is
+evaluated once into a table of 8-bit pixels. Enhancing a sector is then a
+single float32 pass to compute table indices and one lookup, rather than a
+chain of full-size float64 intermediates.
+
+"""
+
+import numpy as np
+from PIL import Image
+
+LUT_SIZE = 4096
+
+
+class LookupTable(object):
+    """Map data values straight to 8-bit pixels
+
+    Values outside the range are clipped to its ends, and missing values
+    become black.
+
+    Parameters
+    ----------
+    vmin, vmax : float
+        Data values mapped to either end of the table.
+    colors : trollimage.colormap.Colormap, optional
+        Colormap spanning vmin to vmax. If not provided the table is a
+        linear greyscale stretch.
+    invert : bool, optional
+        Reverse the greyscale stretch.
+    """
+
+    def __init__(self, vmin, vmax, colors=None, invert=False):
+        self.vmin = vmin
+        self.scale = (LUT_SIZE - 1) / (vmax - vmin)
+        values = np.linspace(vmin, vmax, LUT_SIZE)
+        if colors is None:
+            levels = (values - vmin) / (vmax - vmin)
+            if invert:
+                levels = 1 - levels
+            self.mode = "L"
+        else:
+            levels = np.asarray(colors.colorize(values))[:3].T
+            self.mode = "RGB"
+        self.table = np.round(np.clip(levels, 0, 1) * 255).astype(np.uint8)
+
+    def pil_image(self, data):
+        """Enhance data into an image.
+
+        Parameters
+        ----------
+        data : array_like
+            Two-dimensional product data.
+
+        Returns
+        -------
+        PIL.Image
+        """
+        index = np.array(np.squeeze(data), dtype=np.float32)
+        index -= self.vmin
+        index *= self.scale
+        missing = np.isnan(index)
+        np.clip(index, 0, LUT_SIZE - 1, out=index)
+        index += 0.5
+        index[missing] = 0
+        pixels = self.table[index.astype(np.uint16)]
+        pixels[missing] = 0
+        return Image.fromarray(pixels, self.mode)
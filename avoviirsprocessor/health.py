@@ -0,0 +1,230 @@
+"""
+Report how well a worker is keeping up, not just that it is alive.
+
+The worker records completed tasks, the stage it is in, and every queue
+length it hears. A background thread writes a summary to HEALTH_FILE every
+HEALTH_INTERVAL seconds, so the record stays current while the main loop is
+busy, and a stuck stage shows up as a growing stage age.
+
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor.catalog import get_catalog
+from avoviirsprocessor.metrics import SAMPLE_SIZE, quantile
+
+HEALTH_FILE = tutil.get_env_var("HEALTH_FILE", "/tmp/health.json")
+HEALTH_INTERVAL = 10
+TREND_WINDOW = 30 * 60  # seconds of queue lengths and completions considered
+
+
+def _rate_per_hour(samples, now):
+    """Fit a line to (time, value) samples and return its slope per hour."""
+    if len(samples) < 2 or now - samples[0][0] < TREND_WINDOW / 6:
+        return None
+    times = [t for t, value in samples]
+    values = [value for t, value in samples]
+    mean_t = sum(times) / len(times)
+    mean_v = sum(values) / len(values)
+    spread = sum((t - mean_t) ** 2 for t in times)
+    if not spread:
+        return None
+    slope = sum((t - mean_t) * (v - mean_v) for t, v in zip(times, values)) / spread
+    return slope * 3600
+
+
+class Health(object):
+    """Throughput and progress of a worker"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.tasks = 0
+        self.failed = 0
+        self.latencies = deque(maxlen=SAMPLE_SIZE)
+        self.completions = deque()
+        self.queue_lengths = deque()
+        self.stage = "starting"
+        self.stage_started = time.time()
+        self.newest_processed = None
+        self._writer = None
+
+    def set_stage(self, stage):
+        """Note what the worker is doing now.
+
+        Parameters
+        ----------
+        stage : string
+        """
+        with self._lock:
+            if stage != self.stage:
+                self.stage = stage
+                self.stage_started = time.time()
+
+    def task_done(self, count, seconds, data_time=None, success=True):
+        """Record completed tasks.
+
+        Parameters
+        ----------
+        count : int
+            Number of tasks completed together.
+        seconds : float
+            Time taken.
+        data_time : datetime.datetime, optional
+            End time of the data processed.
+        success : bool, optional
+            Whether the tasks produced products.
+        """
+        now = time.time()
+        with self._lock:
+            self.tasks += count
+            if not success:
+                self.failed += count
+            self.latencies.append(seconds)
+            self.completions.append((now, count))
+            self._trim(self.completions, now)
+            if data_time is not None and (
+                self.newest_processed is None or data_time > self.newest_processed
+            ):
+                self.newest_processed = data_time
+
+    def queue_length(self, length):
+        """Record the length of the task queue.
+
+        Parameters
+        ----------
+        length : int
+        """
+        now = time.time()
+        with self._lock:
+            self.queue_lengths.append((now, length))
+            self._trim(self.queue_lengths, now)
+
+    @staticmethod
+    def _trim(samples, now):
+        while samples and now - samples[0][0] > TREND_WINDOW:
+            samples.popleft()
+
+    def record(self, newest_granule=None):
+        """Summarize health.
+
+        Parameters
+        ----------
+        newest_granule : datetime.datetime, optional
+            End time of the newest SDR granule available.
+
+        Returns
+        -------
+        dict
+        """
+        now = time.time()
+        with self._lock:
+            latencies = sorted(self.latencies)
+            self._trim(self.completions, now)
+            completed = sum(count for t, count in self.completions)
+            queue_lengths = list(self.queue_lengths)
+            newest_processed = self.newest_processed
+            record = {
+                "updated": now,
+                "uptime": now - self.started,
+                "tasks": self.tasks,
+                "failed": self.failed,
+                "stage": self.stage,
+                "stage_seconds": now - self.stage_started,
+                "newest_processed": newest_processed,
+            }
+
+        record["latency_mean"] = sum(latencies) / len(latencies) if latencies else None
+        record["latency_p95"] = quantile(latencies, 0.95) if latencies else None
+        record["queue_length"] = queue_lengths[-1][1] if queue_lengths else None
+        record["queue_trend"] = _rate_per_hour(queue_lengths, now)
+
+        elapsed = min(TREND_WINDOW, now - self.started)
+        if elapsed >= TREND_WINDOW / 6:
+            record["throughput"] = completed / elapsed * 3600
+        else:
+            record["throughput"] = None
+        if record["throughput"] is not None and record["queue_trend"] is not None:
+            arrival_rate = record["throughput"] + record["queue_trend"]
+            record["arrival_rate"] = max(0.0, arrival_rate)
+        else:
+            record["arrival_rate"] = None
+
+        record["newest_granule"] = newest_granule
+        if newest_granule is not None and newest_processed is not None:
+            lag = newest_granule - newest_processed
+            record["lag_seconds"] = max(0.0, lag.total_seconds())
+        else:
+            record["lag_seconds"] = None
+        return record
+
+    def write(self, path=HEALTH_FILE):
+        """Write the health record as JSON, replacing the file atomically.
+
+        Parameters
+        ----------
+        path : string, optional
+            Destination file.
+        """
+        record = self.record(get_catalog().newest())
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(record, f, default=_isoformat)
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Cannot write health to %s", path)
+
+    def start(self, interval=HEALTH_INTERVAL):
+        """Write the health record periodically from a background thread.
+
+        Parameters
+        ----------
+        interval : float, optional
+            Seconds between writes.
+        """
+        if self._writer is not None:
+            return
+
+        def write_forever():
+            while True:
+                try:
+                    self.write()
+                except Exception:
+                    logger.exception("Cannot summarize health")
+                time.sleep(interval)
+
+        self._writer = threading.Thread(target=write_forever, daemon=True)
+        self._writer.start()
+
+
+def _isoformat(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+health = Health()
+set_stage = health.set_stage
+
+
+def read(path=HEALTH_FILE):
+    """Read a health record written by a worker.
+
+    Parameters
+    ----------
+    path : string, optional
+
+    Returns
+    -------
+    dict
+    """
+    with open(path) as f:
+        return json.load(f)
@@ -12,10 +12,14 @@
 """ assess processing health
 """
 
+import argparse
 import zmq
 import signal
 import os
+import json
 import time
+from avoviirsprocessor.health import HEALTH_FILE, read
+from avoviirsprocessor.metrics import METRICS_FILE
 
 UPDATE_PUBLISHER = "tcp://viirscollector:19191"
 MAX_IDLE = 60 * 60
@@ -31,10 +35,90 @@ def print_length(socket):
     print(socket.recv_json()["queue length"])
 
 
+def _arg_parse():
+    description = "Assess processing health."
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "--metrics", action="store_true", help="print stage timings and exit"
+    )
+    parser.add_argument(
+        "--health", action="store_true", help="print the health record and exit"
+    )
+    parser.add_argument(
+        "--throughput",
+        action="store_true",
+        help="fail if processing is stuck or falling behind arrivals",
+    )
+
+    return parser.parse_args()
+
+
+def print_metrics():
+    try:
+        with open(METRICS_FILE) as metrics_file:
+            print(metrics_file.read(), end="")
+    except IOError:
+        print("No metrics yet")
+
+
+def print_health():
+    try:
+        print(json.dumps(read(HEALTH_FILE), indent=2))
+    except (IOError, ValueError):
+        print("No health record yet")
+
+
+def check_throughput():
+    """Fail unless the worker is keeping up with arriving tasks."""
+    try:
+        record = read(HEALTH_FILE)
+    except (IOError, ValueError):
+        print("No health record yet")
+        exit(1)
+
+    age = time.time() - record["updated"]
+    if age > MAX_IDLE:
+        print("Health record is {:.0f} seconds old".format(age))
+        exit(1)
+    if record["stage"] != "waiting" and record["stage_seconds"] > MAX_IDLE:
+        print(
+            "Stuck in {} for {:.0f} seconds".format(
+                record["stage"], record["stage_seconds"]
+            )
+        )
+        exit(1)
+
+    throughput = record["throughput"]
+    arrival_rate = record["arrival_rate"]
+    if throughput is None or arrival_rate is None:
+        print("Not enough history to judge throughput")
+        return
+    print(
+        "{:.1f} tasks/hour completed, {:.1f} tasks/hour arriving".format(
+            throughput, arrival_rate
+        )
+    )
+    if record["queue_length"] and arrival_rate > throughput:
+        print("Falling behind")
+        exit(1)
+    print("OK")
+
+
 def main():
     # let ctrl-c work as it should.
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
+    args = _arg_parse()
+    if args.metrics:
+        print_metrics()
+        return
+    if args.health:
+        print_health()
+        return
+    if args.throughput:
+        check_throughput()
+        return
+
     context = zmq.Context()
     socket = context.socket(zmq.SUB)
     socket.setsockopt_string(zmq.SUBSCRIBE, "")
@@ -0,0 +1,27 @@
+"""
+Start console scripts with the memory budget applied.
+
+Older satpy reads PYTROLL_CHUNK_SIZE when it is imported, and the
+process_message and benchmark modules import satpy as they are loaded. Their
+console scripts therefore start here, where the budget is configured before
+the command's module is imported.
+
+"""
+
+from avoviirsprocessor import budget
+
+
+def process_message():
+    """Run the process_message command."""
+    budget.configure()
+    from avoviirsprocessor.process_message import main
+
+    main()
+
+
+def benchmark():
+    """Run the benchmark command."""
+    budget.configure()
+    from avoviirsprocessor.benchmark import main
+
+    main()
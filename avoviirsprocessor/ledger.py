@@ -0,0 +1,259 @@
+"""
+Remember what has already been published.
+
+Products are recorded by platform, orbit, sector, product, software version,
+and a fingerprint of the SDR files they were made from and the sector's
+definition, so a replayed or duplicated task can skip rendering products
+whose inputs have not changed.
+Uploads are recorded by a digest of the image and its form data for each
+endpoint which acknowledged them, so an image is never posted twice to the
+same endpoint.
+
+The ledger is a SQLite database in LEDGER_FILE, shared by every process on
+the host. It is disabled unless LEDGER_FILE is set. Records older than
+LEDGER_RETENTION_DAYS days are pruned.
+
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor.version import __version__
+
+LEDGER_FILE = tutil.get_env_var("LEDGER_FILE", "")
+LEDGER_TIMEOUT = 30  # seconds to wait for another process's write
+LEDGER_RETENTION_DAYS = float(tutil.get_env_var("LEDGER_RETENTION_DAYS", 7))
+PRUNE_INTERVAL = 3600  # seconds between pruning old records
+
+SCHEMA = (
+    """CREATE TABLE IF NOT EXISTS products (
+        platform TEXT, orbit TEXT, sector TEXT, product TEXT, inputs TEXT,
+        version TEXT, filename TEXT, published REAL,
+        PRIMARY KEY (platform, orbit, sector, product, inputs, version))""",
+    """CREATE TABLE IF NOT EXISTS uploads (
+        image TEXT, endpoint TEXT, acknowledged REAL,
+        PRIMARY KEY (image, endpoint))""",
+)
+
+
+def fingerprint(filenames):
+    """Identify a set of input files by name, size, and modification time.
+
+    Parameters
+    ----------
+    filenames : iterable of string
+
+    Returns
+    -------
+    string
+        Hex digest, which changes if any file is added, removed, or
+        rewritten.
+    """
+    digest = hashlib.sha1()
+    for filename in sorted(filenames):
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            continue
+        digest.update(
+            "{}:{}:{}\n".format(
+                os.path.basename(filename), stat.st_size, stat.st_mtime_ns
+            ).encode()
+        )
+    return digest.hexdigest()
+
+
+def sector_inputs(inputs, sector_def):
+    """Combine an input fingerprint with a sector's definition.
+
+    A product is then made again if its sector is redefined, even from the
+    same SDR files.
+
+    Parameters
+    ----------
+    inputs : string
+        Fingerprint of the input files, as returned by fingerprint.
+    sector_def : pyresample.geometry.AreaDefinition
+
+    Returns
+    -------
+    string
+    """
+    return "{}-{}".format(inputs, sector_def.update_hash().hexdigest())
+
+
+def upload_key(pngbytes, volcview_args):
+    """Identify an upload by its image and form data.
+
+    Parameters
+    ----------
+    pngbytes : bytes-like
+        PNG-encoded image.
+    volcview_args : dict
+        Form data describing the image.
+
+    Returns
+    -------
+    string
+    """
+    digest = hashlib.sha1(pngbytes)
+    digest.update(json.dumps(volcview_args, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class Ledger(object):
+    """Record of published products and acknowledged uploads
+
+    Parameters
+    ----------
+    path : string
+        SQLite database file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._pruned = 0
+
+    def _connection(self):
+        # a connection must not be used across a fork
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._conn = sqlite3.connect(
+                self.path, timeout=LEDGER_TIMEOUT, check_same_thread=False
+            )
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                self._conn.execute(statement)
+            self._pid = os.getpid()
+        return self._conn
+
+    def _execute(self, statement, parameters):
+        try:
+            with self._lock:
+                conn = self._connection()
+                self._prune(conn)
+                with conn:
+                    return conn.execute(statement, parameters).fetchone()
+        except sqlite3.Error:
+            logger.exception("Cannot use ledger %s", self.path)
+            return None
+
+    def _prune(self, conn):
+        # called with the lock held
+        now = time.time()
+        if now - self._pruned < PRUNE_INTERVAL:
+            return
+        self._pruned = now
+        cutoff = now - LEDGER_RETENTION_DAYS * 24 * 60 * 60
+        with conn:
+            conn.execute("DELETE FROM products WHERE published < ?", (cutoff,))
+            conn.execute("DELETE FROM uploads WHERE acknowledged < ?", (cutoff,))
+
+    def lookup(self, platform, orbit, sector, product, inputs):
+        """Find a product made from the same inputs by this version.
+
+        Parameters
+        ----------
+        platform, orbit, sector, product : string
+        inputs : string
+            Fingerprint of the inputs, as returned by sector_inputs.
+
+        Returns
+        -------
+        string
+            Filename of the published image, or None.
+        """
+        row = self._execute(
+            "SELECT filename FROM products WHERE platform=? AND orbit=? AND "
+            "sector=? AND product=? AND inputs=? AND version=?",
+            (platform, str(orbit), sector, product, inputs, __version__),
+        )
+        return row[0] if row else None
+
+    def record(self, platform, orbit, sector, product, inputs, filename):
+        """Record a published product.
+
+        Parameters
+        ----------
+        platform, orbit, sector, product : string
+        inputs : string
+            Fingerprint of the inputs, as returned by sector_inputs.
+        filename : string
+            Where the image was written.
+        """
+        self._execute(
+            "INSERT OR REPLACE INTO products VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                platform,
+                str(orbit),
+                sector,
+                product,
+                inputs,
+                __version__,
+                filename,
+                time.time(),
+            ),
+        )
+
+    def acknowledged(self, image, endpoint):
+        """Check whether an endpoint has accepted an upload.
+
+        Parameters
+        ----------
+        image : string
+            Upload key, as returned by upload_key.
+        endpoint : string
+
+        Returns
+        -------
+        bool
+        """
+        row = self._execute(
+            "SELECT 1 FROM uploads WHERE image=? AND endpoint=?", (image, endpoint)
+        )
+        return row is not None
+
+    def acknowledge(self, image, endpoint):
+        """Record that an endpoint accepted an upload.
+
+        Parameters
+        ----------
+        image : string
+            Upload key, as returned by upload_key.
+        endpoint : string
+        """
+        self._execute(
+            "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?)",
+            (image, endpoint, time.time()),
+        )
+
+
+_ledger = None
+_ledger_lock = threading.Lock()
+
+
+def get_ledger():
+    """Return the ledger shared by this process, creating it if needed.
+
+    Returns
+    -------
+    ledger.Ledger
+        The ledger, or None if LEDGER_FILE is not set.
+    """
+    global _ledger
+
+    if not LEDGER_FILE:
+        return None
+    with _ledger_lock:
+        if _ledger is None:
+            _ledger = Ledger(LEDGER_FILE)
+    return _ledger
@@ -0,0 +1,261 @@
+"""
+Measure where processing time goes.
+
+Each stage of processing is timed and tagged with product, sector, and
+platform where they apply. Summaries are written in the Prometheus text
+format to METRICS_FILE, next to the heartbeat file, and optionally served
+over HTTP on METRICS_PORT.
+
+"""
+
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+
+METRICS_FILE = tutil.get_env_var("METRICS_FILE", "/tmp/metrics.prom")
+METRICS_PORT = int(tutil.get_env_var("METRICS_PORT", 0))
+SAMPLE_SIZE = 500
+QUANTILES = (0.5, 0.9, 0.95, 0.99)
+PREFIX = "avoviirs"
+
+
+def _labels(tags, **extra):
+    tags = dict(tags, **extra)
+    if not tags:
+        return ""
+    pairs = []
+    for key, value in sorted(tags.items()):
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        pairs.append('{}="{}"'.format(key, value.replace("\n", "\\n")))
+    return "{" + ",".join(pairs) + "}"
+
+
+def quantile(samples, q):
+    """Return a quantile of a sorted sequence, by nearest rank."""
+    if not samples:
+        return float("nan")
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+
+class Series(object):
+    """Observations of one stage with one set of tags"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+    def observe(self, seconds, nbytes):
+        self.count += 1
+        self.seconds += seconds
+        self.samples.append(seconds)
+        if nbytes:
+            self.bytes += nbytes
+
+
+class Metrics(object):
+    """Collection of stage timings"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._series = {}
+        self._forwarded = None
+
+    def observe(self, stage, seconds, nbytes=None, **tags):
+        """Record one observation of a stage.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage.
+        seconds : float
+            Time spent in the stage.
+        nbytes : int, optional
+            Bytes produced or moved by the stage.
+        tags : dict
+            Labels such as product, sector, and platform.
+        """
+        key = (stage, tuple(sorted(tags.items())))
+        with self._lock:
+            if self._forwarded is not None:
+                self._forwarded.append((key, seconds, nbytes))
+                return
+            if key not in self._series:
+                self._series[key] = Series()
+            self._series[key].observe(seconds, nbytes)
+
+    @contextmanager
+    def timer(self, stage, **tags):
+        """Time a block of code.
+
+        Yields a dict; set its "bytes" item to record a byte count.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage.
+        tags : dict
+            Labels such as product, sector, and platform.
+        """
+        extra = {}
+        start = time.perf_counter()
+        try:
+            yield extra
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(stage, elapsed, extra.get("bytes"), **tags)
+
+    def forward(self):
+        """Hold observations for another process rather than recording them.
+
+        Used in forked workers, which return their observations to the
+        parent with take_forwarded(). The lock is replaced rather than
+        acquired, as the fork may have copied it while another thread,
+        which does not exist in the worker, held it.
+        """
+        self._lock = threading.Lock()
+        self._series = {}
+        self._forwarded = []
+
+    def take_forwarded(self):
+        """Return and clear observations held by forward()."""
+        with self._lock:
+            forwarded, self._forwarded = self._forwarded, []
+        return forwarded
+
+    def observe_forwarded(self, forwarded):
+        """Record observations returned by take_forwarded()."""
+        for (stage, tags), seconds, nbytes in forwarded:
+            self.observe(stage, seconds, nbytes, **dict(tags))
+
+    def reset(self):
+        """Discard all observations."""
+        with self._lock:
+            self._series = {}
+
+    def snapshot(self):
+        """Summarize observations.
+
+        Returns
+        -------
+        list
+            A dict for each stage and set of tags.
+        """
+        summary = []
+        with self._lock:
+            for (stage, tags), values in sorted(self._series.items()):
+                samples = sorted(values.samples)
+                record = {
+                    "stage": stage,
+                    "tags": dict(tags),
+                    "count": values.count,
+                    "seconds": values.seconds,
+                    "bytes": values.bytes,
+                }
+                for q in QUANTILES:
+                    record["p{}".format(int(q * 100))] = quantile(samples, q)
+                summary.append(record)
+        return summary
+
+    def render(self):
+        """Format metrics in the Prometheus text format.
+
+        Returns
+        -------
+        string
+        """
+        seconds = "{}_stage_seconds".format(PREFIX)
+        nbytes = "{}_stage_bytes_total".format(PREFIX)
+        lines = [
+            "# HELP {} Time spent in each processing stage.".format(seconds),
+            "# TYPE {} summary".format(seconds),
+        ]
+        byte_lines = [
+            "# HELP {} Bytes produced by each processing stage.".format(nbytes),
+            "# TYPE {} counter".format(nbytes),
+        ]
+        with self._lock:
+            series = sorted(self._series.items())
+            for (stage, tags), values in series:
+                tags = dict(tags, stage=stage)
+                samples = sorted(values.samples)
+                for q in QUANTILES:
+                    lines.append(
+                        "{}{} {:.6f}".format(
+                            seconds, _labels(tags, quantile=q), quantile(samples, q)
+                        )
+                    )
+                lines.append(
+                    "{}_sum{} {:.6f}".format(seconds, _labels(tags), values.seconds)
+                )
+                lines.append(
+                    "{}_count{} {}".format(seconds, _labels(tags), values.count)
+                )
+                if values.bytes:
+                    byte_lines.append(
+                        "{}{} {}".format(nbytes, _labels(tags), values.bytes)
+                    )
+
+        return "\n".join(lines + byte_lines) + "\n"
+
+    def write(self, path=METRICS_FILE):
+        """Write metrics to a file, replacing it atomically.
+
+        Parameters
+        ----------
+        path : string, optional
+            Destination file.
+        """
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        try:
+            with open(tmp_path, "w") as f:
+                f.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError:
+            logger.exception("Cannot write metrics to %s", path)
+
+
+metrics = Metrics()
+timer = metrics.timer
+
+
+class _MetricsServer(ThreadingMixIn, HTTPServer):
+    # http.server.ThreadingHTTPServer needs Python 3.7
+    daemon_threads = True
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(port=METRICS_PORT):
+    """Serve metrics over HTTP from a background thread.
+
+    Parameters
+    ----------
+    port : int, optional
+        TCP port. Nothing is served if zero.
+    """
+    if not port:
+        return None
+    server = _MetricsServer(("", port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info("Serving metrics on port %d", port)
+    return server
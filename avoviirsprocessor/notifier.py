@@ -0,0 +1,153 @@
+"""
+Tell downstream consumers which sectors are ready.
+
+Notifications go to SECTOR_PROXY over one long-lived socket per process.
+A notification is queued once a sector image has been written and accepted
+by volcview. A sender thread sends queued notifications as soon as they
+arrive, so they do not wait for the worker's next task. Each is sent as its
+own message holding one JSON document, as consumers expect.
+
+The socket is an XPUB, which sees the subscriptions forwarded by the proxy.
+The first flush waits up to NOTIFY_WAIT seconds for a subscription, rather
+than dropping notifications while the connection is still being made. Once
+NOTIFY_HWM notifications are waiting, later ones are dropped and counted, so
+processing never blocks on a slow consumer.
+
+"""
+
+import json
+import os
+import threading
+import time
+
+import zmq
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor.metrics import metrics
+
+SECTOR_PROXY = "tcp://viirstools:29292"
+NOTIFY_HWM = int(tutil.get_env_var("NOTIFY_HWM", 1000))
+NOTIFY_WAIT = float(tutil.get_env_var("NOTIFY_WAIT", 5))
+NOTIFY_LINGER = 1000  # ms to keep trying to deliver at exit
+
+
+class Notifier(object):
+    """Batched sector notifications
+
+    Parameters
+    ----------
+    context : zmq.Context
+        ZMQ context to use.
+    address : string, optional
+        Where to connect.
+    hwm : int, optional
+        Notifications queued before further notifications are dropped.
+    """
+
+    def __init__(self, context, address=SECTOR_PROXY, hwm=NOTIFY_HWM):
+        self.socket = context.socket(zmq.XPUB)
+        self.socket.setsockopt(zmq.SNDHWM, hwm)
+        self.socket.setsockopt(zmq.XPUB_NODROP, 1)
+        self.socket.setsockopt(zmq.LINGER, NOTIFY_LINGER)
+        self.socket.connect(address)
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._ready = threading.Event()
+        self._sender = None
+        self._pid = None
+        self._pending = []
+        self._waited = False
+        self.subscribed = False
+        self.sent = 0
+        self.dropped = 0
+
+    def notify(self, volcview_args):
+        """Queue a notification for the sender thread.
+
+        This may be called from any thread.
+
+        Parameters
+        ----------
+        volcview_args : dict
+            Form data describing a published image.
+        """
+        with self._lock:
+            self._pending.append(json.dumps(volcview_args).encode())
+            # threads do not survive a fork
+            if self._sender is None or self._pid != os.getpid():
+                self._sender = threading.Thread(target=self._send_forever, daemon=True)
+                self._sender.start()
+                self._pid = os.getpid()
+        self._ready.set()
+
+    def _send_forever(self):
+        while True:
+            self._ready.wait()
+            self._ready.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Cannot send sector notifications")
+
+    def pending(self):
+        """Return the number of notifications waiting to be sent."""
+        with self._lock:
+            return len(self._pending)
+
+    def _read_subscriptions(self, timeout):
+        # subscriptions arrive as messages starting with 1, unsubscriptions 0
+        deadline = time.time() + timeout
+        while True:
+            while self.socket.poll(0):
+                self.subscribed = self.socket.recv()[:1] == b"\x01"
+            remaining = deadline - time.time()
+            if self.subscribed or remaining <= 0:
+                return
+            self.socket.poll(remaining * 1000)
+
+    def flush(self):
+        """Send queued notifications, one message each.
+
+        The sender thread does this as notifications arrive; calling it
+        sends them straight away. It may be called from any thread.
+
+        Returns
+        -------
+        int
+            Number of notifications sent.
+        """
+        with self._send_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            if not batch:
+                return 0
+
+            start = time.perf_counter()
+            self._read_subscriptions(0 if self._waited else NOTIFY_WAIT)
+            self._waited = True
+            sent = 0
+            outcome = "sent"
+            if not self.subscribed:
+                outcome = "no_subscriber"
+            else:
+                try:
+                    for document in batch:
+                        self.socket.send(document, zmq.NOBLOCK)
+                        sent += 1
+                except zmq.Again:
+                    outcome = "dropped"
+            metrics.observe(
+                "notify",
+                time.perf_counter() - start,
+                sum(len(document) for document in batch[:sent]),
+                outcome=outcome,
+            )
+
+            self.sent += sent
+            if sent < len(batch):
+                self.dropped += len(batch) - sent
+                logger.warning(
+                    "%d sector notifications not sent: %s", len(batch) - sent, outcome
+                )
+            logger.debug("Sent %d sector notifications", sent)
+            return sent
@@ -0,0 +1,133 @@
+"""
+Draw coastlines and borders on volcview images.
+
+Sector grids are fixed, so the overlay for each sector is drawn once with
+pycoast into an RGBA layer, saved in OVERLAY_CACHE_DIR, and memory-mapped
+on later use. Applying the overlay is then a single alpha blend.
+
+"""
+
+import os
+
+import numpy as np
+from PIL import Image
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor.decorations import GOLDENROD
+
+COAST_DIR = "/usr/local/gshhg"
+COAST_COLOR = GOLDENROD
+COAST_WIDTH = 0.5
+OVERLAY_CACHE_DIR = tutil.get_env_var("OVERLAY_CACHE_DIR", "/var/tmp/overlays")
+
+_overlays = {}
+
+
+def _coast_resolution(sector_def):
+    """Choose a GSHHG resolution suitable for a sector's pixel size."""
+    x_min, y_min, x_max, y_max = sector_def.area_extent
+    height, width = sector_def.shape
+    pixel_size = min((x_max - x_min) / width, (y_max - y_min) / height)
+    if pixel_size > 25000:
+        return "c"
+    elif pixel_size > 5000:
+        return "l"
+    elif pixel_size > 1000:
+        return "i"
+    elif pixel_size > 200:
+        return "h"
+    else:
+        return "f"
+
+
+def draw_overlay(sector_def):
+    """Draw coastlines and borders for a sector.
+
+    Parameters
+    ----------
+    sector_def : pyresample.geometry.AreaDefinition
+
+    Returns
+    -------
+    numpy.ndarray
+        RGBA overlay with the sector's shape.
+    """
+    from pycoast import ContourWriterAGG
+
+    logger.debug("Drawing overlay for %s", sector_def.area_id)
+    height, width = sector_def.shape
+    layer = Image.new("RGBA", (width, height), (0, 0, 0, 0))
+    resolution = _coast_resolution(sector_def)
+    contour_writer = ContourWriterAGG(COAST_DIR)
+    contour_writer.add_coastlines(
+        layer,
+        sector_def,
+        resolution=resolution,
+        outline=COAST_COLOR,
+        width=COAST_WIDTH,
+        level=1,
+    )
+    contour_writer.add_borders(
+        layer,
+        sector_def,
+        resolution=resolution,
+        outline=COAST_COLOR,
+        width=COAST_WIDTH,
+        level=1,
+    )
+    return np.asarray(layer)
+
+
+def get_overlay(sector_def):
+    """Retrieve a sector's overlay, drawing it if needed.
+
+    Parameters
+    ----------
+    sector_def : pyresample.geometry.AreaDefinition
+
+    Returns
+    -------
+    numpy.ndarray
+        RGBA overlay with the sector's shape.
+    """
+    key = "{}-{}".format(sector_def.area_id, sector_def.update_hash().hexdigest())
+    if key in _overlays:
+        return _overlays[key]
+
+    cache_file = os.path.join(OVERLAY_CACHE_DIR, "{}.npy".format(key))
+    try:
+        overlay = np.load(cache_file, mmap_mode="r")
+    except (IOError, ValueError):
+        overlay = draw_overlay(sector_def)
+        tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+        try:
+            os.makedirs(OVERLAY_CACHE_DIR, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                np.save(f, overlay)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            logger.exception("Cannot cache overlay in %s", cache_file)
+
+    _overlays[key] = overlay
+    return overlay
+
+
+def add_coastlines(pilimg, sector_def):
+    """Blend a sector's coastlines and borders onto an image.
+
+    Parameters
+    ----------
+    pilimg : PIL.Image
+        Image covering the sector.
+    sector_def : pyresample.geometry.AreaDefinition
+
+    Returns
+    -------
+    PIL.Image
+        RGB image with the overlay applied.
+    """
+    overlay = get_overlay(sector_def)
+    alpha = overlay[..., 3:].astype(np.uint16)
+    base = np.asarray(pilimg.convert("RGB"), dtype=np.uint16)
+    blended = (base * (255 - alpha) + overlay[..., :3] * alpha + 127) // 255
+    return Image.fromarray(blended.astype(np.uint8), "RGB")
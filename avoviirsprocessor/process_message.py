@@ -1,13 +1,26 @@
 import argparse
+import multiprocessing
+import time
 from posttroll.message import Message
-from avoviirsprocessor.processor import publish_products
+from avoviirsprocessor import logger
+from avoviirsprocessor.catalog import find_files
+from avoviirsprocessor import processor
+from avoviirsprocessor.processor import ORBIT_SLACK, get_pass_key, publish_pass
+from avoviirsprocessor.runtime import get_runtime
+from avoviirsprocessor import uploader
 from avoviirsprocessor.coreprocessors import *  # NOQA
 
 
 def _arg_parse():
-    description = "Reprocesses a serialized message in a file."
+    description = "Reprocesses serialized messages in files."
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument("message", help="path to serialized message", nargs="*")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of passes to process concurrently",
+    )
 
     return parser.parse_args()
 
@@ -28,11 +41,143 @@ def get_messages(file_list):
     return messages
 
 
+def get_granules(message):
+    """List the SDR files a message would be processed from.
+
+    Parameters
+    ----------
+    message : posttroll.message.Message
+
+    Returns
+    -------
+    tuple
+        platform and sorted SDR file paths, or the pass key if no files
+        were found.
+    """
+    data = message.data
+    filenames = find_files(
+        data["platform_name"],
+        data["start_time"] - ORBIT_SLACK,
+        data["end_time"] + ORBIT_SLACK,
+    )
+    if not filenames:
+        return get_pass_key(message)
+    return (data["platform_name"], tuple(sorted(filenames)))
+
+
+def group_by_granules(messages):
+    """Group messages which would be processed from the same SDR files.
+
+    Only one message for each product is kept in a group.
+
+    Parameters
+    ----------
+    messages : iterable of posttroll.message.Message
+
+    Returns
+    -------
+    list
+        lists of messages, one list per set of SDR files.
+    """
+    groups = {}
+    for message in messages:
+        products = groups.setdefault(get_granules(message), {})
+        products.setdefault(message.subject, message)
+    return [list(products.values()) for products in groups.values()]
+
+
+def reprocess(messages):
+    """Process messages sharing SDR files, waiting for uploads to finish.
+
+    Parameters
+    ----------
+    messages : list of posttroll.message.Message
+
+    Returns
+    -------
+    tuple
+        number of products, whether they succeeded, and seconds taken.
+    """
+    start = time.time()
+    success = False
+    try:
+        failed = publish_pass(messages)
+        uploader.drain()
+        # notifications are queued as uploads are accepted
+        get_runtime().notifier.flush()
+        success = not failed
+    except NotImplementedError:
+        logger.exception("Crap. I accepted a message I can't process.")
+    except ValueError:
+        logger.exception("I got a message, but couldn't find the data")
+    except KeyError:
+        logger.exception("missing data, skipping")
+    return len(messages), success, time.time() - start
+
+
+def _init_worker():
+    # pool workers are daemons, which cannot start sector workers of their own
+    processor.SECTOR_WORKERS = 1
+
+
+def _describe(messages):
+    data = messages[0].data
+    products = ",".join(m.subject.split("/")[-1] for m in messages)
+    return "{} {} {}".format(data["platform_name"], data["start_time"], products)
+
+
 def main():
     args = _arg_parse()
-    for (key, message) in get_messages(args.message):
-        print(key)
-        publish_products(message)
+    messages = get_messages(args.message)
+    groups = group_by_granules(messages.values())
+    total = sum(len(group) for group in groups)
+    print(
+        "{} products from {} messages in {} passes".format(
+            total, len(args.message), len(groups)
+        )
+    )
+
+    start = time.time()
+    done = 0
+    failed = 0
+    if args.workers > 1:
+        context = multiprocessing.get_context("fork")
+        pool = context.Pool(args.workers, initializer=_init_worker)
+        results = pool.imap(reprocess, groups)
+    else:
+        pool = None
+        results = map(reprocess, groups)
+    try:
+        for index, (group, (count, success, seconds)) in enumerate(
+            zip(groups, results), 1
+        ):
+            done += count
+            if not success:
+                failed += count
+            elapsed = time.time() - start
+            rate = done / elapsed * 60
+            remaining = (total - done) / rate if rate else 0
+            print(
+                "[{}/{}] {} {} in {:.1f}s; {:.1f} products/min, {:.0f} min left".format(
+                    index,
+                    len(groups),
+                    _describe(group),
+                    "done" if success else "FAILED",
+                    seconds,
+                    rate,
+                    remaining,
+                )
+            )
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    uploader.drain()
+
+    elapsed = time.time() - start
+    print(
+        "{} products, {} failed, in {:.1f} minutes".format(done, failed, elapsed / 60)
+    )
 
 
 if __name__ == "__main__":
@@ -7,35 +7,52 @@ creating images for volcview.
 """
 
 import calendar
-import requests
-from pyresample import parse_area_file
-from trollsched.satpass import Pass
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+import dask
+from avoviirsprocessor import budget
 from satpy.scene import Scene
-from satpy import find_files_and_readers
-from satpy.writers import to_image, add_overlay
+from satpy.writers import to_image
 from pydecorate import DecoratorAGG
+from pyresample.geometry import SwathDefinition
 from avoviirsprocessor import logger
-import aggdraw
+from avoviirsprocessor.catalog import find_files
+from avoviirsprocessor.decorations import (
+    GOLDENROD,
+    TYPEFACE,
+    FONT_SIZE,
+    colormap_key,
+    get_colorbar,
+    get_font,
+)
+from avoviirsprocessor.health import set_stage
+from avoviirsprocessor.ledger import fingerprint, get_ledger, sector_inputs
+from avoviirsprocessor.metrics import metrics
+from avoviirsprocessor.overlays import add_coastlines
+from avoviirsprocessor.resampling import resample, resample_cache
+from avoviirsprocessor.runtime import get_runtime
+from avoviirsprocessor.sectors import find_covered_sectors
+from avoviirsprocessor.tiers import tiers_for
+from avoviirsprocessor.uploader import get_uploader
+from avoviirsprocessor.writer import get_writer
 import tomputils.util as tutil
 from abc import ABC, abstractmethod
 from datetime import timedelta
 import io
-import zmq
-from satpy.utils import debug_on
+import os
 
-GOLDENROD = (218, 165, 32)
 PNG_DIR = "/viirs/png"
 MSG_DIR = "/viirs/messages"
-TYPEFACE = "/app/avoviirsprocessor/Cousine-Bold.ttf"
-FONT_SIZE = 14
-COAST_DIR = "/usr/local/gshhg"
-AREA_DEF = "/app/trollconfig/areas.def"
 ORBIT_SLACK = timedelta(minutes=30)
-SECTOR_PROXY = "tcp://viirstools:29292"
-POST_TIMEOUT = 30
+SECTOR_WORKERS = int(tutil.get_env_var("SECTOR_WORKERS", 1))
+PNG_COMPRESS_LEVEL = int(tutil.get_env_var("PNG_COMPRESS_LEVEL", 6))
+PNG_PALETTE_PRODUCTS = tutil.get_env_var("PNG_PALETTE_PRODUCTS", "").split(",")
 
+# processors shared with forked sector workers, see render_sectors()
+_pass_processors = []
 
-def processor_factory(message):
+
+def processor_factory(message, scene=None):
     """Instanciate an approprieate processor object.
 
     Search for subclasses of Processor and return an initalized object
@@ -45,6 +62,9 @@ def processor_factory(message):
     ----------
     message : posttroll.message.Message
         The message needing to be processed.
+    scene : satpy.scene.Scene, optional
+        A scene shared with other processors working on the same pass. If
+        not provided, a new scene will be created.
 
     Returns
     -------
@@ -54,56 +74,367 @@ def processor_factory(message):
     product = message.subject.split("/")[-1]
     for processor in Processor.__subclasses__():
         if processor.Product == product:
-            return processor(message)
+            return processor(message, scene=scene)
     print("found {}".format(len(Processor.__subclasses__())))
     raise NotImplementedError("I don't know how to {}".format(product))
 
 
+def build_processors(messages, scene_factory=None):
+    """Create a processor for each message, skipping those which fail.
+
+    A message for an unknown product, or whose files cannot be found, is
+    logged and skipped so the other products of its pass are still made.
+
+    Parameters
+    ----------
+    messages : list of posttroll.message.Message
+        Messages covering the same pass, one per product.
+    scene_factory : callable, optional
+        Called to create a scene for each processor. If not provided, the
+        first processor created finds the files and the rest share its
+        scene.
+
+    Returns
+    -------
+    tuple
+        list of processors, and list of the messages which were skipped.
+    """
+    processors = []
+    failed = []
+    scene = None
+    for message in messages:
+        if scene_factory is not None:
+            scene = scene_factory()
+        try:
+            processor = processor_factory(message, scene=scene)
+        except (NotImplementedError, ValueError, KeyError):
+            logger.exception("Cannot process %s, skipping it", message.subject)
+            failed.append(message)
+            continue
+        scene = processor.scene
+        processors.append(processor)
+    return processors, failed
+
+
+def get_pass_key(message):
+    """Identify the pass covered by a message.
+
+    Parameters
+    ----------
+    message : posttroll.message.Message
+
+    Returns
+    -------
+    tuple
+        platform, start time, and end time of the pass
+    """
+    data = message.data
+    return (data["platform_name"], data["start_time"], data["end_time"])
+
+
+def group_messages(messages):
+    """Group messages which cover the same pass.
+
+    Parameters
+    ----------
+    messages : list of posttroll.message.Message
+
+    Returns
+    -------
+    list
+        lists of messages, one per pass, in order of first appearance.
+    """
+    groups = {}
+    for message in messages:
+        groups.setdefault(get_pass_key(message), []).append(message)
+    return list(groups.values())
+
+
+def coverage_threshold():
+    """Return the minimum coverage for a sector to be produced."""
+    return float(tutil.get_env_var("COVERAGE_THRESHOLD", 0.1))
+
+
 def publish_products(message):
-    logger.debug("Processing message: %s", message.encode())
-    processor = processor_factory(message)
-    processor.load_data()
-
-    for sector_def in processor.find_sectors():
-        file_base = processor.get_file_base(sector_def)
-        message_filename = "{}/{}.txt".format(MSG_DIR, file_base)
-        with open(message_filename, "w") as msg_file:
-            msg_file.write(message.encode())
-        pilimg = processor.get_image(sector_def)
-        processor.write_pilimg(pilimg, file_base)
-        processor.write_old_volcview(pilimg, sector_def)
-        processor.publish_pilimg(pilimg, file_base, sector_def.area_id)
+    return publish_pass([message])
+
+
+def publish_pass(messages):
+    """Create and deliver several products from a single pass.
+
+    All products share a single scene, so SDR files are found and read once,
+    coverage is checked once, and resampling lookup tables are computed once
+    per sector. Sectors are chosen before data is loaded, so a product with
+    no sector to render is never loaded. Composites are not generated on the
+    swath; processors needing them generate them for each sector.
+
+    Parameters
+    ----------
+    messages : list of posttroll.message.Message
+        Messages covering the same pass, one per product.
 
+    Returns
+    -------
+    list
+        Messages which could not be processed.
+    """
+    for message in messages:
+        logger.debug("Processing message: %s", message.encode())
+    set_stage("find_files")
+    processors, failed = build_processors(messages)
+    if not processors:
+        return failed
+    scene = processors[0].scene
+
+    platform = processors[0].data["platform_name"]
+    set_stage("find_sectors")
+    with metrics.timer("find_sectors", platform=platform):
+        sectors = processors[0].find_sectors()
+
+    jobs = plan_renders(processors, sectors)
+    needed = [p for p in processors if any(p in todo for _, todo in jobs)]
+    bands = set()
+    for processor in needed:
+        bands.update(processor.Bands)
+    set_stage("load_data")
+    with metrics.timer("load_data", platform=platform):
+        scene.load(sorted(bands), generate=False)
+        for processor in needed:
+            processor.load_data()
+
+    set_stage("render")
+    for sector_def, rendered, images in render_sectors(jobs):
+        for processor, (pngimg, outputs) in zip(rendered, images):
+            publish_sector(processor, sector_def, pngimg, outputs)
+
+    # files must be in place before consumers are told about them; sectors
+    # whose files could not be written were neither recorded nor uploaded.
+    # Notifications for uploads still under way are sent as they finish.
+    set_stage("write")
+    write_failures = get_writer().flush()
+    if write_failures:
+        logger.error(
+            "Cannot write %d sector images, not announcing them", write_failures
+        )
+    get_runtime().notifier.flush()
+    metrics.write()
     logger.debug("All done with this task.")
+    return failed
 
 
-def publish_product(filename, pngimg, volcview_args):
-    user = tutil.get_env_var("VOLCVIEW_USER")
-    passwd = tutil.get_env_var("VOLCVIEW_PASSWD")
-    headers = {"username": user, "password": passwd}
-    files = {"file": (filename, pngimg)}
-    for endpoint in tutil.get_env_var("VV_ENDPOINTS").split(","):
-        pngimg.seek(0)
-        url = endpoint + "/imageApi/uploadImage"
-        print("publishing image to {}".format(url))
-        print("data {}".format(volcview_args))
-        try:
-            response = requests.post(
-                url,
-                headers=headers,
-                data=volcview_args,
-                files=files,
-                timeout=POST_TIMEOUT,
-                verify=False,
+def plan_renders(processors, sectors):
+    """Decide which products need to be rendered for each sector.
+
+    Products are not rendered for sectors they do not cover, such as a
+    visible product for a sector at night. Products the ledger shows were
+    already made from the same SDR files are not rendered again; their
+    images are only resubmitted for upload, which skips endpoints that
+    already accepted them.
+
+    Parameters
+    ----------
+    processors : list of processor.Processor
+        Processors sharing a scene.
+    sectors : list of pyresample.geometry.AreaDefinition
+
+    Returns
+    -------
+    list
+        sector and list of processors to render it, for each sector with
+        something to render.
+    """
+    ledger = get_ledger()
+    filenames = processors[0].filenames
+    inputs = fingerprint(filenames) if ledger is not None and filenames else None
+    jobs = []
+    for sector_def in sectors:
+        todo = []
+        for processor in processors:
+            if not processor.covers(sector_def):
+                logger.debug("%s skips %s", processor.product, sector_def.area_id)
+                continue
+            if inputs is None:
+                todo.append(processor)
+                continue
+            processor.inputs = inputs
+            image_filename = ledger.lookup(
+                processor.data["platform_name"],
+                processor.data["orbit_number"],
+                sector_def.area_id,
+                processor.product,
+                sector_inputs(inputs, sector_def),
             )
-            print("server said: {}".format(response.text))
-            image_size = len(pngimg.getbuffer())
-            print(f"image size {image_size}")
-        except requests.exceptions.RequestException as e:
-            print(e)
+            if image_filename and os.path.exists(image_filename):
+                logger.info("Already published %s, skipping", image_filename)
+                processor.redeliver(image_filename, sector_def.area_id)
+            else:
+                todo.append(processor)
+        if todo:
+            jobs.append((sector_def, todo))
+    return jobs
+
+
+def render_sectors(jobs):
+    """Render and encode images for each sector, possibly in parallel.
 
-    print("returning {}".format(response))
-    return response
+    With SECTOR_WORKERS greater than one, sectors are rendered by a pool of
+    forked worker processes. Loaded data and swath geolocation are persisted
+    in memory before the pool is created so workers share them with this
+    process rather than receiving pickled arrays or rereading SDR files.
+    Lookup tables a worker computes are returned to this process's cache.
+
+    Parameters
+    ----------
+    jobs : list of tuple
+        Sector and the processors, with data loaded, to render it.
+
+    Yields
+    ------
+    tuple
+        sector, its processors, and a list of rendered images, one per
+        processor, in the order the jobs were provided. Each image is a
+        PNG-encoded image and a dict of other outputs, as returned by
+        Processor.render.
+    """
+    global _pass_processors
+
+    workers = min(SECTOR_WORKERS, len(jobs))
+    if workers < 2:
+        for sector_def, processors in jobs:
+            yield sector_def, processors, [p.render(sector_def) for p in processors]
+        return
+
+    _pass_processors = []
+    for sector_def, processors in jobs:
+        for processor in processors:
+            if processor not in _pass_processors:
+                processor.persist_data()
+                _pass_processors.append(processor)
+    _persist_geolocation(_pass_processors[0].scene)
+    tasks = [
+        (sector_def, [_pass_processors.index(p) for p in processors])
+        for sector_def, processors in jobs
+    ]
+    try:
+        context = multiprocessing.get_context("fork")
+        with context.Pool(workers, initializer=_init_sector_worker) as pool:
+            for (sector_def, processors), (images, observations, tables) in zip(
+                jobs, pool.imap(_render_sector, tasks)
+            ):
+                metrics.observe_forwarded(observations)
+                for key, indices in tables.items():
+                    resample_cache.add(key, indices)
+                yield sector_def, processors, images
+    finally:
+        _pass_processors = []
+
+
+def _persist_geolocation(scene):
+    # swaths are shared by datasets from the same granules, persist each once
+    swaths = {}
+    for dataset in scene:
+        area = dataset.attrs.get("area")
+        if isinstance(area, SwathDefinition):
+            swaths[id(area)] = area
+    for area in swaths.values():
+        area.lons, area.lats = dask.persist(area.lons, area.lats)
+
+
+def _init_sector_worker():
+    # dask's thread pool does not survive a fork
+    dask.config.set(scheduler="synchronous")
+    metrics.forward()
+    resample_cache.record_added()
+
+
+def _render_sector(task):
+    # memoryviews cannot be pickled, so return bytes to the parent
+    sector_def, indices = task
+    images = []
+    for i in indices:
+        pngimg, outputs = _pass_processors[i].render(sector_def)
+        images.append((bytes(pngimg), outputs))
+    return images, metrics.take_forwarded(), resample_cache.take_added()
+
+
+def publish_sector(processor, sector_def, pngimg, outputs=None):
+    """Deliver a single product for a single sector.
+
+    The image is encoded once and handed to the output writer. Files are
+    written in the background. Once they are all in place the product is
+    recorded in the ledger and the same buffer is queued for upload. A
+    notification is queued once an endpoint has accepted the upload and
+    sent when the notifier is next flushed.
+
+    Parameters
+    ----------
+    processor : processor.Processor
+        The processor which rendered the image.
+    sector_def : pyresample.geometry.AreaDefinition
+        The sector to be produced.
+    pngimg : bytes-like
+        The PNG-encoded image.
+    outputs : dict, optional
+        Other encoded outputs, keyed by filename suffix.
+    """
+    file_base = processor.get_file_base(sector_def)
+    writer = get_writer()
+    writer.submit(_write_sector, processor, sector_def, file_base, pngimg, outputs)
+
+
+def _write_sector(processor, sector_def, file_base, pngimg, outputs):
+    # runs on an output writer thread
+    message_filename = "{}/{}.txt".format(MSG_DIR, file_base)
+    get_writer().write(message_filename, bytes(processor.message.encode(), "utf-8"))
+    image_filename = processor.write_png(pngimg, file_base)
+    for suffix, data in (outputs or {}).items():
+        processor.write_output(data, file_base, suffix)
+    processor.write_old_volcview(pngimg, sector_def, image_filename)
+    ledger = get_ledger()
+    if ledger is not None and processor.inputs is not None:
+        ledger.record(
+            processor.data["platform_name"],
+            processor.data["orbit_number"],
+            sector_def.area_id,
+            processor.product,
+            sector_inputs(processor.inputs, sector_def),
+            image_filename,
+        )
+    processor.publish_png(pngimg, file_base, sector_def.area_id)
+
+
+def make_output_dirs(sectors):
+    """Create the output directories, once, rather than on first write.
+
+    Parameters
+    ----------
+    sectors : iterable of pyresample.geometry.AreaDefinition
+        Sectors whose old volcview directories are needed.
+    """
+    writer = get_writer()
+    writer.make_dirs(MSG_DIR)
+    writer.make_dirs(PNG_DIR)
+    for sector_def in sectors:
+        writer.make_dirs("{}/{}".format(PNG_DIR, sector_def.area_id[-4:]))
+
+
+def publish_product(filename, pngimg, volcview_args, callback=None):
+    """Queue an image for delivery to volcview.
+
+    Images are posted to every endpoint in VV_ENDPOINTS in the background.
+
+    Parameters
+    ----------
+    filename : string
+        Name of the image file.
+    pngimg : bytes-like
+        PNG-encoded image.
+    volcview_args : dict
+        Form data describing the image.
+    callback : callable, optional
+        Called once every endpoint is done, see uploader.Uploader.submit.
+    """
+    get_uploader().submit(filename, pngimg, volcview_args, callback)
 
 
 class Processor(ABC):
@@ -120,20 +451,41 @@ class Processor(ABC):
     product_label: string
        The product-specific portion of the labled shown on the volcview
        image.
+    scene : satpy.scene.Scene, optional
+       A scene shared with other processors. If not provided, a new scene
+       will be created.
     """
 
-    def __init__(self, message, product, volcview_band, product_label):
-        debug_on()
+    Bands = []
+
+    def __init__(self, message, product, volcview_band, product_label, scene=None):
         self.message = message
         self.product = product
         self.product_label = product_label
         self.volcview_band = volcview_band
         self.data = message.data
-        self.color_bar_font = aggdraw.Font(GOLDENROD, TYPEFACE, size=FONT_SIZE)
-        self.scene = self._create_scene()
-        context = zmq.Context()
-        self.publisher = context.socket(zmq.PUB)
-        self.publisher.connect(SECTOR_PROXY)
+        self.color_bar_font = get_font(GOLDENROD, FONT_SIZE)
+        self.colors = None
+        self.lookup_table = None
+        self._start_time = None
+        self.filenames = []
+        self.inputs = None
+        self.scene = scene if scene is not None else self._create_scene()
+        self.notifier = get_runtime().notifier
+
+    @property
+    def start_time(self):
+        """Start of the pass, as shown on images and used in filenames.
+
+        Defaults to the start of the scene.
+        """
+        if self._start_time is None:
+            return self.scene.start_time
+        return self._start_time
+
+    @start_time.setter
+    def start_time(self, start_time):
+        self._start_time = start_time
 
     @abstractmethod
     def load_data(self):
@@ -141,6 +493,26 @@ class Processor(ABC):
         """
         pass
 
+    def persist_data(self):
+        """Compute product data and hold it in memory.
+        """
+        self.scene[self.product] = self.scene[self.product].persist()
+
+    def timer(self, stage, area_id=None):
+        """Time a stage of processing this product.
+
+        Parameters
+        ----------
+        stage : string
+            Name of the stage.
+        area_id : string, optional
+            Sector being processed, if any.
+        """
+        tags = {"product": self.product, "platform": self.data["platform_name"]}
+        if area_id is not None:
+            tags["sector"] = area_id
+        return metrics.timer(stage, **tags)
+
     def apply_colorbar(self, dcimg):
         """Apply a colorbar to an image.
 
@@ -154,6 +526,9 @@ class Processor(ABC):
     def enhance_image(self, img):
         """Apply enhancements to image data.
 
+        Not used if the processor has a lookup_table, which enhances data
+        directly.
+
         Parameters
         ----------
         img : trollimage.xrimage.XRImage
@@ -164,15 +539,25 @@ class Processor(ABC):
     def decorate_pilimg(self, pilimg):
         """Apply decorations to an image
 
+        The colorbar is rendered once for each product, image size, and
+        colormap and pasted in. Only the label is drawn for every image.
+
         Parameters
         ----------
         pilimg : PIL.Image
         """
-        dc = DecoratorAGG(pilimg)
+        width, height = pilimg.size
+        key = (self.product, pilimg.size, colormap_key(self.colors))
+        colorbar = get_colorbar(key, pilimg.size, self.apply_colorbar)
+        if colorbar is not None:
+            height -= colorbar.height
+            pilimg.paste(colorbar, (0, height), colorbar)
+
+        label_region = pilimg.crop((0, 0, width, height))
+        dc = DecoratorAGG(label_region)
         dc.align_bottom()
-
-        self.apply_colorbar(dc)
         self.apply_label(dc)
+        pilimg.paste(label_region, (0, 0))
 
     def draw_colorbar(self, dcimg, colors, tick_marks, minor_tick_marks):
         """Draw a colorbar on an image
@@ -206,7 +591,7 @@ class Processor(ABC):
          dcimg : pydecorate.DecoratorAGG
             Image to label
         """
-        start_string = self.scene.start_time.strftime("%m/%d/%Y %H:%M UTC")
+        start_string = self.start_time.strftime("%m/%d/%Y %H:%M UTC")
         label = "{} {} VIIRS {}".format(
             start_string, self.data["platform_name"], self.product_label
         )
@@ -230,16 +615,20 @@ class Processor(ABC):
             Inialized scene object
         """
         data = self.message.data
-        filter_parameters = {
-            "start_time": data["start_time"] - ORBIT_SLACK,
-            "end_time": data["end_time"] + ORBIT_SLACK,
-            "platform_name": data["platform_name"],
-        }
-        filenames = find_files_and_readers(
-            base_dir="/viirs/sdr",
-            reader="viirs_sdr",
-            filter_parameters=filter_parameters,
-        )
+        platform = data["platform_name"]
+        with metrics.timer("find_files", platform=platform):
+            filenames = find_files(
+                platform,
+                data["start_time"] - ORBIT_SLACK,
+                data["end_time"] + ORBIT_SLACK,
+            )
+        if budget.MEMORY_BUDGET:
+            with metrics.timer("trim_granules", platform=platform):
+                sectors = find_covered_sectors(
+                    platform, data["start_time"], data["end_time"], coverage_threshold()
+                )
+                filenames = budget.trim_granules(platform, filenames, sectors)
+        self.filenames = filenames
         try:
             scene = Scene(filenames=filenames, reader="viirs_sdr")
         except ValueError as e:
@@ -256,42 +645,69 @@ class Processor(ABC):
         list
             area_id of each sector with some coverage.
         """
-        data = self.message.data
-        overpass = Pass(
-            data["platform_name"],
+        return find_covered_sectors(
+            self.message.data["platform_name"],
             self.scene.start_time,
             self.scene.end_time,
-            instrument="viirs",
-        )
-        logger.debug(f"Created overpass {overpass}")
-        logger.debug(
-            f"args: {data['platform_name']} :: "
-            "{self.scene.start_time} :: {self.scene.end_time}"
+            coverage_threshold(),
         )
-        sectors = []
-        coverage_threashold = float(tutil.get_env_var("COVERAGE_THRESHOLD", 0.1))
-        for sector_def in parse_area_file(AREA_DEF):
-            logger.debug("Checking coverage for %s", sector_def.area_id)
-            coverage = overpass.area_coverage(sector_def)
-            logger.debug("{} coverage: {}".format(sector_def.area_id, coverage))
-            if coverage > coverage_threashold:
-                sectors.append(sector_def)
-        return sectors
-
-    def get_image(self, sector_def):
-        local = self.scene.resample(sector_def)
-        img = to_image(local[self.product].squeeze())
-        self.enhance_image(img)
-        img = add_overlay(
-            img, area=sector_def, coast_dir=COAST_DIR, color=GOLDENROD, fill_value=0
-        )
-        pilimg = img.pil_image()
-        self.decorate_pilimg(pilimg)
+
+    def covers(self, sector_def):
+        """Decide whether this product should be made for a sector.
+
+        Parameters
+        ----------
+        sector_def : pyresample.geometry.AreaDefinition
+
+        Returns
+        -------
+        bool
+        """
+        return True
+
+    def resample_sector(self, sector_def):
+        """Resample product data to a sector.
+
+        Parameters
+        ----------
+        sector_def : pyresample.geometry.AreaDefinition
+
+        Returns
+        -------
+        xarray.DataArray
+            Product data on the sector grid, not yet computed.
+        """
+        return resample(self.scene[self.product], sector_def)
+
+    def draw_image(self, local, sector_def):
+        """Enhance and decorate product data covering a sector.
+
+        Parameters
+        ----------
+        local : xarray.DataArray
+            Product data resampled to the sector.
+        sector_def : pyresample.geometry.AreaDefinition
+
+        Returns
+        -------
+        PIL.Image
+        """
+        with self.timer("enhance", sector_def.area_id):
+            if self.lookup_table is not None:
+                pilimg = self.lookup_table.pil_image(local.values)
+            else:
+                img = to_image(local.squeeze())
+                self.enhance_image(img)
+                pilimg = img.pil_image(fill_value=0)
+        with self.timer("overlay", sector_def.area_id):
+            pilimg = add_coastlines(pilimg, sector_def)
+        with self.timer("decorate", sector_def.area_id):
+            self.decorate_pilimg(pilimg)
         return pilimg
 
     def get_file_base(self, sector_def):
         data = self.message.data
-        time_str = self.scene.start_time.strftime("%Y%m%d.%H%M")
+        time_str = self.start_time.strftime("%Y%m%d.%H%M")
         filename_str = "testing-{}-{}-{}-viirs-{}-{}"
         filename = filename_str.format(
             time_str,
@@ -302,32 +718,162 @@ class Processor(ABC):
         )
         return filename
 
-    def write_pilimg(self, pilimg, file_base):
+    def render(self, sector_def):
+        """Render and encode an image of a sector, and any other outputs.
+
+        Parameters
+        ----------
+        sector_def : pyresample.geometry.AreaDefinition
+
+        Returns
+        -------
+        tuple
+            PNG-encoded image and other outputs, as returned by
+            encode_outputs.
+        """
+        with self.timer("resample", sector_def.area_id):
+            local = self.resample_sector(sector_def).compute()
+        pilimg = self.draw_image(local, sector_def)
+        return self.encode_outputs(pilimg, local, sector_def)
+
+    def encode_outputs(self, pilimg, local, sector_def):
+        """Encode an image and the other outputs configured for this product.
+
+        Each output is encoded in its own thread.
+
+        Parameters
+        ----------
+        pilimg : PIL.Image
+            Decorated image of the sector.
+        local : xarray.DataArray
+            Product data resampled to the sector.
+        sector_def : pyresample.geometry.AreaDefinition
+
+        Returns
+        -------
+        tuple
+            PNG-encoded image, and a dict of other encoded outputs keyed by
+            filename suffix.
+        """
+        tiers = tiers_for(self.product)
+        if not tiers:
+            return self.encode_pilimg(pilimg, sector_def.area_id), {}
+
+        with ThreadPoolExecutor(len(tiers) + 1) as pool:
+            pngimg = pool.submit(self.encode_pilimg, pilimg, sector_def.area_id)
+            futures = {
+                suffix: pool.submit(
+                    self._encode_tier, encode, suffix, pilimg, local, sector_def
+                )
+                for suffix, encode in tiers
+            }
+            outputs = {suffix: future.result() for suffix, future in futures.items()}
+        # an output which could not be made is left out
+        outputs = {suffix: data for suffix, data in outputs.items() if data is not None}
+        return pngimg.result(), outputs
+
+    def _encode_tier(self, encode, suffix, pilimg, local, sector_def):
+        with metrics.timer(
+            "tier_encode",
+            product=self.product,
+            platform=self.data["platform_name"],
+            sector=sector_def.area_id,
+            tier=suffix,
+        ) as timing:
+            data = encode(pilimg, local, sector_def, PNG_COMPRESS_LEVEL)
+            timing["bytes"] = len(data) if data is not None else 0
+        return data
+
+    def encode_pilimg(self, pilimg, area_id):
+        """Encode an image as PNG.
+
+        Products listed in PNG_PALETTE_PRODUCTS are reduced to a 256 color
+        palette first, which suits the single-band products well.
+
+        Parameters
+        ----------
+        pilimg : PIL.Image
+        area_id : string
+
+        Returns
+        -------
+        memoryview
+            PNG-encoded image.
+        """
+        with self.timer("png_encode", area_id) as timing:
+            if self.product in PNG_PALETTE_PRODUCTS:
+                pilimg = pilimg.quantize(256)
+            pngimg = io.BytesIO()
+            pilimg.save(pngimg, format="PNG", compress_level=PNG_COMPRESS_LEVEL)
+            timing["bytes"] = len(pngimg.getbuffer())
+        return pngimg.getbuffer()
+
+    def write_png(self, pngimg, file_base):
         image_filename = "{}/{}.png".format(PNG_DIR, file_base)
         print("writing {}".format(image_filename))
-        pilimg.save(image_filename)
+        with self.timer("write") as timing:
+            get_writer().write(image_filename, pngimg)
+            timing["bytes"] = len(pngimg)
+        return image_filename
+
+    def write_output(self, data, file_base, suffix):
+        filename = "{}/{}.{}".format(PNG_DIR, file_base, suffix)
+        with self.timer("write") as timing:
+            get_writer().write(filename, data)
+            timing["bytes"] = len(data)
+        return filename
 
-    def write_old_volcview(self, pilimg, sector_def):
-        time_str = self.scene.start_time.strftime("%Y%m%d.%H%M")
+    def write_old_volcview(self, pngimg, sector_def, image_filename=None):
+        time_str = self.start_time.strftime("%Y%m%d.%H%M")
         file_path = "{}/{}".format(PNG_DIR, sector_def.area_id[-4:])
         product = "ASH" if self.product == "btd" else self.product.upper()
         filename_str = "{}.viirs.--.--.{}.{}.png".format(
             time_str, sector_def.area_id, product
         )
         logger.info("writing file %s/%s", file_path, filename_str)
-        pilimg.save("{}/{}".format(file_path, filename_str))
+        old_filename = "{}/{}".format(file_path, filename_str)
+        writer = get_writer()
+        writer.make_dirs(file_path)
+        with self.timer("write", sector_def.area_id) as timing:
+            try:
+                writer.link(image_filename, old_filename)
+            except (OSError, TypeError):
+                # no image to link to, or it's on another filesystem
+                writer.write(old_filename, pngimg)
+                timing["bytes"] = len(pngimg)
         logger.debug("finished writing file %s/%s", file_path, filename_str)
 
-    def publish_pilimg(self, pilimg, file_base, area_id):
-        unixtime = calendar.timegm(self.scene.start_time.timetuple())
-        volcview_args = {
+    def get_volcview_args(self, area_id):
+        unixtime = calendar.timegm(self.start_time.timetuple())
+        return {
             "sector": area_id,
             "band": self.volcview_band,
             "dataType": "viirs",
             "imageUnixtime": unixtime,
         }
+
+    def publish_png(self, pngimg, file_base, area_id):
+        volcview_args = self.get_volcview_args(area_id)
         filename = file_base + ".png"
-        pngimg = io.BytesIO()
-        pilimg.save(pngimg, format="PNG")
-        publish_product(filename, pngimg, volcview_args)
-        self.publisher.send_json(volcview_args)
+
+        def delivered(accepted):
+            if accepted:
+                self.notifier.notify(volcview_args)
+            else:
+                logger.warning("No endpoint accepted %s, not announcing it", filename)
+
+        publish_product(filename, pngimg, volcview_args, delivered)
+
+    def redeliver(self, image_filename, area_id):
+        """Resubmit a previously published image for upload.
+
+        Parameters
+        ----------
+        image_filename : string
+            Where the image was written.
+        area_id : string
+        """
+        with open(image_filename, "rb") as f:
+            pngimg = f.read()
+        filename = os.path.basename(image_filename)
+        publish_product(filename, pngimg, self.get_volcview_args(area_id))
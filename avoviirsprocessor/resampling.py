@@ -0,0 +1,350 @@
+"""
+Resample swath data to volcview sectors.
+
+This module keeps the nearest-neighbour lookup tables used to resample a
+swath to a sector so they can be reused by every product sharing that swath
+geometry. Tables are held in memory with LRU eviction and, if
+RESAMPLE_CACHE_DIR is set, persisted to disk so they survive a restart.
+Each lookup is recorded in metrics as the resample_lookup stage, tagged
+with whether the tables were found in memory, read from disk, or computed.
+
+"""
+
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import dask.array as da
+import xarray as xr
+from pyresample.geometry import SwathDefinition
+from pyresample.kd_tree import XArrayResamplerNN
+from pyresample.resampler import BaseResampler
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor.metrics import metrics
+from avoviirsprocessor.sectors import EARTH_RADIUS, sector_cap, unit_vectors
+
+INDEX_ARRAYS = (
+    "valid_input_index",
+    "valid_output_index",
+    "index_array",
+    "distance_array",
+)
+DEFAULT_RADIUS = 10000
+CROP_STRIDE = 16  # swath pixels between geolocation samples when cropping
+
+
+def geometry_key(source_area, sector_def):
+    """Identify a source swath and target sector pair.
+
+    Parameters
+    ----------
+    source_area : pyresample.geometry.BaseDefinition
+        Geometry of the data to be resampled.
+    sector_def : pyresample.geometry.AreaDefinition
+        Target sector.
+
+    Returns
+    -------
+    str
+        Key which is stable across processes for the same geometry.
+    """
+    return "{}-{}".format(
+        source_area.update_hash().hexdigest(), sector_def.update_hash().hexdigest()
+    )
+
+
+def _radius_of_influence(source_area):
+    try:
+        return source_area.lons.resolution * 3
+    except (AttributeError, TypeError):
+        return DEFAULT_RADIUS
+
+
+def swath_window(source_area, sector_def):
+    """Find the part of a swath which may fall within a sector.
+
+    Geolocation is sampled every CROP_STRIDE pixels and compared against the
+    spherical cap enclosing the sector, with a margin for the pixels between
+    samples.
+
+    Parameters
+    ----------
+    source_area : pyresample.geometry.SwathDefinition
+    sector_def : pyresample.geometry.AreaDefinition
+
+    Returns
+    -------
+    tuple
+        row and column slices, or None if the swath misses the sector.
+    """
+    lons = np.asarray(source_area.lons[::CROP_STRIDE, ::CROP_STRIDE])
+    lats = np.asarray(source_area.lats[::CROP_STRIDE, ::CROP_STRIDE])
+    center, radius = sector_cap(sector_def)
+    margin = _radius_of_influence(source_area) * CROP_STRIDE / 1000  # km
+    with np.errstate(invalid="ignore"):
+        angles = np.arccos(np.clip(unit_vectors(lons, lats) @ center, -1, 1))
+        near = angles <= radius + margin / EARTH_RADIUS
+    rows = np.flatnonzero(near.any(axis=1))
+    cols = np.flatnonzero(near.any(axis=0))
+    if not rows.size:
+        return None
+
+    height, width = source_area.shape
+    return _pad(rows, height), _pad(cols, width)
+
+
+def _pad(samples, length):
+    # extend a run of sampled pixels to the samples on either side
+    start = max(0, (samples[0] - 1) * CROP_STRIDE)
+    return slice(start, min(length, (samples[-1] + 2) * CROP_STRIDE))
+
+
+def _window_key(window):
+    rows, cols = window
+    return "{}_{}-{}_{}".format(rows.start, rows.stop, cols.start, cols.stop)
+
+
+def _empty_sector(dataset, sector_def):
+    shape = dataset.shape[:-2] + sector_def.shape
+    coords = {d: dataset.coords[d] for d in dataset.dims[:-2] if d in dataset.coords}
+    local = xr.DataArray(
+        da.full(shape, np.nan, dtype=dataset.dtype), dims=dataset.dims, coords=coords
+    )
+    local.attrs = dataset.attrs.copy()
+    local.attrs["area"] = sector_def
+    return local
+
+
+class ResampleCache(object):
+    """Cache of nearest-neighbour lookup tables
+
+    Parameters
+    ----------
+    size : int
+        Maximum number of lookup tables held in memory.
+    cache_dir : string, optional
+        Directory used to persist lookup tables between runs.
+    """
+
+    def __init__(self, size, cache_dir=None):
+        self.size = size
+        self.cache_dir = cache_dir
+        self._indices = OrderedDict()
+        self._windows = OrderedDict()
+        self._added = None
+
+    def __len__(self):
+        return len(self._indices)
+
+    def resample(self, dataset, sector_def):
+        """Resample a dataset to a sector.
+
+        Parameters
+        ----------
+        dataset : xarray.DataArray
+            Swath data with an area attribute.
+        sector_def : pyresample.geometry.AreaDefinition
+            Target sector.
+
+        Returns
+        -------
+        xarray.DataArray
+            Data resampled to the sector.
+        """
+        source_area = dataset.attrs["area"]
+        key = geometry_key(source_area, sector_def)
+        window = self.get_window(source_area, sector_def, key)
+        if window is None:
+            logger.debug("%s misses %s", key, sector_def.area_id)
+            return _empty_sector(dataset, sector_def)
+
+        rows, cols = window
+        source_area = source_area[rows, cols]
+        dataset = dataset[..., rows, cols]
+        dataset.attrs = dict(dataset.attrs, area=source_area)
+        resampler = XArrayResamplerNN(
+            source_area,
+            sector_def,
+            radius_of_influence=_radius_of_influence(source_area),
+            neighbours=1,
+        )
+        key = "{}-{}".format(key, _window_key(window))
+        indices = self.get_indices(resampler, key)
+        for name, index in indices.items():
+            setattr(resampler, name, da.from_array(index, chunks="auto"))
+
+        local = resampler.get_sample_from_neighbour_info(dataset, fill_value=np.nan)
+        local.attrs = dataset.attrs.copy()
+        local.attrs["area"] = sector_def
+        return local
+
+    def get_window(self, source_area, sector_def, key):
+        """Retrieve the part of a swath covering a sector, finding it if needed.
+
+        Parameters
+        ----------
+        source_area : pyresample.geometry.SwathDefinition
+        sector_def : pyresample.geometry.AreaDefinition
+        key : string
+            Geometry key, as returned by geometry_key.
+
+        Returns
+        -------
+        tuple
+            row and column slices, or None if the swath misses the sector.
+        """
+        if key in self._windows:
+            self._windows.move_to_end(key)
+            return self._windows[key]
+
+        if isinstance(source_area, SwathDefinition):
+            window = swath_window(source_area, sector_def)
+        else:
+            # an area, not a swath, so cannot be cropped by rows and columns
+            height, width = source_area.shape
+            window = (slice(0, height), slice(0, width))
+        self._windows[key] = window
+        while len(self._windows) > self.size:
+            self._windows.popitem(last=False)
+
+        return window
+
+    def get_indices(self, resampler, key):
+        """Retrieve lookup tables, computing them if needed.
+
+        Parameters
+        ----------
+        resampler : pyresample.kd_tree.XArrayResamplerNN
+            Resampler used to compute missing tables.
+        key : string
+            Geometry key, as returned by geometry_key.
+
+        Returns
+        -------
+        dict
+            Lookup tables as numpy arrays, keyed by resampler attribute.
+        """
+        start = time.perf_counter()
+        if key in self._indices:
+            self._indices.move_to_end(key)
+            metrics.observe(
+                "resample_lookup", time.perf_counter() - start, outcome="memory"
+            )
+            return self._indices[key]
+
+        outcome = "disk"
+        indices = self._load(key)
+        if indices is None:
+            outcome = "computed"
+            logger.debug("Computing resampling indices for %s", key)
+            resampler.get_neighbour_info()
+            names = [n for n in INDEX_ARRAYS if getattr(resampler, n) is not None]
+            arrays = da.compute(*[getattr(resampler, name) for name in names])
+            indices = dict(zip(names, arrays))
+            self._save(key, indices)
+
+        if self._added is not None:
+            self._added[key] = indices
+        self.add(key, indices)
+        metrics.observe("resample_lookup", time.perf_counter() - start, outcome=outcome)
+        return indices
+
+    def add(self, key, indices):
+        """Hold lookup tables in memory.
+
+        Parameters
+        ----------
+        key : string
+            Geometry key, as returned by geometry_key.
+        indices : dict
+            Lookup tables as numpy arrays, keyed by resampler attribute.
+        """
+        self._indices[key] = indices
+        self._indices.move_to_end(key)
+        while len(self._indices) > self.size:
+            self._indices.popitem(last=False)
+
+    def record_added(self):
+        """Start keeping lookup tables added from now on for take_added().
+
+        Used in forked workers, whose tables would otherwise be lost when
+        they exit.
+        """
+        self._added = {}
+
+    def take_added(self):
+        """Return and clear lookup tables kept since record_added().
+
+        Returns
+        -------
+        dict
+            Lookup tables keyed by geometry key, for add().
+        """
+        added, self._added = self._added, {}
+        return added
+
+    def _cache_file(self, key):
+        return os.path.join(self.cache_dir, "nn_lut-{}.npz".format(key))
+
+    def _load(self, key):
+        if not self.cache_dir:
+            return None
+
+        try:
+            with np.load(self._cache_file(key)) as cache:
+                logger.debug("Read resampling indices for %s", key)
+                return {name: cache[name] for name in cache.files}
+        except (IOError, ValueError):
+            return None
+
+    def _save(self, key, indices):
+        if not self.cache_dir:
+            return
+
+        cache_file = self._cache_file(key)
+        tmp_file = "{}.{}.tmp".format(cache_file, os.getpid())
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                np.savez(f, **indices)
+            os.replace(tmp_file, cache_file)
+        except OSError:
+            logger.exception("Cannot cache resampling indices in %s", cache_file)
+
+
+resample_cache = ResampleCache(
+    int(tutil.get_env_var("RESAMPLE_CACHE_SIZE", 64)),
+    tutil.get_env_var("RESAMPLE_CACHE_DIR", ""),
+)
+
+
+class SceneResampler(BaseResampler):
+    """Satpy resampler backed by the shared lookup table cache
+
+    Passing this class as the resampler to satpy.scene.Scene.resample
+    crops and resamples every dataset in a scene with cached tables, so
+    composites can be generated on the sector grid.
+    """
+
+    def resample(self, data, **kwargs):
+        return resample_cache.resample(data, self.target_geo_def)
+
+
+def resample(dataset, sector_def):
+    """Resample a dataset to a sector using the shared cache.
+
+    Parameters
+    ----------
+    dataset : xarray.DataArray
+        Swath data with an area attribute.
+    sector_def : pyresample.geometry.AreaDefinition
+        Target sector.
+
+    Returns
+    -------
+    xarray.DataArray
+        Data resampled to the sector.
+    """
+    return resample_cache.resample(dataset, sector_def)
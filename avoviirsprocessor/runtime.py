@@ -0,0 +1,130 @@
+"""
+State shared by every task a worker handles.
+
+Building a ZMQ context and notification socket, fonts, sector definitions,
+output directories, and satpy reader configuration is slow compared to the
+work needed to hand a task off, so a worker builds them once and keeps them
+for its lifetime.
+
+This module avoids importing the processing stack, so a worker can connect
+and ask for work while satpy and friends load in the background.
+
+"""
+
+import threading
+import time
+
+import zmq
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor import uploader
+from avoviirsprocessor.health import set_stage
+from avoviirsprocessor.notifier import Notifier
+
+IDLE_REST = float(tutil.get_env_var("IDLE_REST", 10))
+UPLOAD_HIGH_WATER = int(tutil.get_env_var("UPLOAD_HIGH_WATER", 100))
+
+
+class Runtime(object):
+    """Long-lived worker resources
+
+    Parameters
+    ----------
+    context : zmq.Context, optional
+        ZMQ context to use. The process-wide context is used if not
+        provided.
+    """
+
+    def __init__(self, context=None):
+        self.context = context or zmq.Context.instance()
+        self.notifier = Notifier(self.context)
+        self._warmer = None
+
+    def warm(self):
+        """Load state which would otherwise be loaded by the first task.
+
+        This imports the processors, and with them satpy and the rest of the
+        processing stack.
+        """
+        start = time.time()
+        from satpy.readers import configs_for_reader
+        from satpy.utils import debug_on
+        import avoviirsprocessor.coreprocessors  # NOQA
+        from avoviirsprocessor.catalog import get_catalog
+        from avoviirsprocessor.decorations import GOLDENROD, FONT_SIZE, get_font
+        from avoviirsprocessor.processor import make_output_dirs
+        from avoviirsprocessor.sectors import get_sector_index
+
+        debug_on()
+        logger.debug("Imported in %.3f seconds", time.time() - start)
+        make_output_dirs(get_sector_index().sectors)
+        get_catalog().scan(force=True)
+        get_font(GOLDENROD, FONT_SIZE)
+        get_font((0, 0, 0), 14)
+        list(configs_for_reader("viirs_sdr"))
+        logger.debug("Warmed up in %.3f seconds", time.time() - start)
+
+    def prewarm(self):
+        """Warm up in a background thread.
+
+        The worker can request a task meanwhile. A task which arrives first
+        waits only for the imports it needs.
+        """
+        if self._warmer is not None:
+            return
+
+        def warm():
+            try:
+                self.warm()
+            except Exception:
+                logger.exception("Cannot warm up")
+
+        self._warmer = threading.Thread(target=warm, daemon=True)
+        self._warmer.start()
+
+    def rest(self, queue_length):
+        """Pause between tasks.
+
+        A worker only pauses when no tasks are waiting, so a worker with a
+        backlog does not pause at all. If uploads are falling behind, wait
+        for them to catch up before accepting more work.
+
+        Parameters
+        ----------
+        queue_length : int
+            Most recently reported number of tasks waiting.
+        """
+        backlog = uploader.pending()
+        if backlog > UPLOAD_HIGH_WATER:
+            logger.info("%d uploads pending, waiting for them to drain", backlog)
+            set_stage("drain_uploads")
+            uploader.drain()
+
+        if queue_length:
+            logger.debug("%d tasks waiting, not resting", queue_length)
+        else:
+            set_stage("rest")
+            logger.debug("Resting for %.1f seconds", IDLE_REST)
+            time.sleep(IDLE_REST)
+
+
+_runtime = None
+
+
+def get_runtime(context=None):
+    """Return the runtime shared by this process, creating it if needed.
+
+    Parameters
+    ----------
+    context : zmq.Context, optional
+        ZMQ context to use if the runtime must be created.
+
+    Returns
+    -------
+    runtime.Runtime
+    """
+    global _runtime
+
+    if _runtime is None:
+        _runtime = Runtime(context)
+    return _runtime
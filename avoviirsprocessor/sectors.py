@@ -0,0 +1,200 @@
+"""
+Find volcview sectors covered by a pass.
+
+Sector definitions are parsed once and indexed by the spherical cap enclosing
+each sector. Before the full coverage calculation, sectors are screened
+against the satellite ground track, so only sectors within reach of the
+swath are checked. Results are remembered for each pass so every product
+from that pass can reuse them.
+
+"""
+
+from collections import OrderedDict
+from datetime import timedelta
+
+import numpy as np
+from pyorbital.astronomy import sun_zenith_angle
+from pyresample import parse_area_file
+from trollsched.satpass import Pass
+from avoviirsprocessor import logger
+
+AREA_DEF = "/app/trollconfig/areas.def"
+EARTH_RADIUS = 6371.0  # km
+SWATH_HALF_WIDTH = 1600  # km, VIIRS swath is about 3040 km wide
+TRACK_STEP = timedelta(minutes=1)
+TRACK_SPEED = 7  # km/s, a bit faster than the VIIRS sub-satellite point
+TRACK_REACH = SWATH_HALF_WIDTH + TRACK_STEP.total_seconds() * TRACK_SPEED / 2
+COVERAGE_CACHE_SIZE = 32
+
+
+def unit_vectors(lons, lats):
+    """Convert longitudes and latitudes, in degrees, to unit vectors."""
+    lons = np.radians(lons)
+    lats = np.radians(lats)
+    return np.stack(
+        (np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)),
+        axis=-1,
+    )
+
+
+def _sample_lonlats(sector_def):
+    # corners, edge midpoints, and center, with the center fifth
+    height, width = sector_def.shape
+    rows = (0, (height - 1) // 2, height - 1)
+    cols = (0, (width - 1) // 2, width - 1)
+    lonlats = [sector_def.get_lonlat(row, col) for row in rows for col in cols]
+    return np.array(lonlats).T
+
+
+def sector_cap(sector_def):
+    """Find a spherical cap enclosing a sector.
+
+    Parameters
+    ----------
+    sector_def : pyresample.geometry.AreaDefinition
+
+    Returns
+    -------
+    tuple
+        unit vector of the sector center and cap radius in radians.
+    """
+    points = unit_vectors(*_sample_lonlats(sector_def))
+    center = points[4]
+    radius = np.max(np.arccos(np.clip(points @ center, -1, 1)))
+    return center, radius
+
+
+def min_sun_zenith(sector_def, times):
+    """Find the smallest solar zenith angle over a sector.
+
+    Parameters
+    ----------
+    sector_def : pyresample.geometry.AreaDefinition
+    times : iterable of datetime.datetime
+        Times to consider, such as the start and end of a pass.
+
+    Returns
+    -------
+    float
+        Solar zenith angle in degrees, sampled at the corners, edge
+        midpoints, and center of the sector.
+    """
+    lons, lats = _sample_lonlats(sector_def)
+    return min(np.min(sun_zenith_angle(t, lons, lats)) for t in times)
+
+
+class SectorIndex(object):
+    """Sector definitions with bounding caps
+
+    Parameters
+    ----------
+    area_file : string
+        Path to the area definition file.
+    """
+
+    def __init__(self, area_file):
+        self.sectors = parse_area_file(area_file)
+        caps = [sector_cap(sector_def) for sector_def in self.sectors]
+        self.centers = np.array([center for center, radius in caps])
+        self.radii = np.array([radius for center, radius in caps])
+
+    def candidates(self, lons, lats, distance):
+        """Find sectors which may lie within some distance of a path.
+
+        Parameters
+        ----------
+        lons, lats : array_like
+            Points, in degrees, along the path.
+        distance : float
+            Distance, in km, from the path.
+
+        Returns
+        -------
+        list
+            AreaDefinition of each sector within reach.
+        """
+        points = unit_vectors(np.asarray(lons), np.asarray(lats))
+        angles = np.arccos(np.clip(self.centers @ points.T, -1, 1)).min(axis=1)
+        reach = self.radii + distance / EARTH_RADIUS
+        return [s for s, near in zip(self.sectors, angles <= reach) if near]
+
+
+_sector_index = None
+_coverage_cache = OrderedDict()
+
+
+def get_sector_index():
+    """Return the sector index, parsing AREA_DEF the first time.
+
+    Returns
+    -------
+    sectors.SectorIndex
+    """
+    global _sector_index
+
+    if _sector_index is None:
+        _sector_index = SectorIndex(AREA_DEF)
+    return _sector_index
+
+
+def ground_track(overpass, start_time, end_time):
+    """Sample the sub-satellite point of a pass.
+
+    Parameters
+    ----------
+    overpass : trollsched.satpass.Pass
+    start_time, end_time : datetime.datetime
+
+    Returns
+    -------
+    tuple
+        longitudes and latitudes, in degrees, at TRACK_STEP intervals.
+    """
+    times = [start_time]
+    while times[-1] < end_time:
+        times.append(min(times[-1] + TRACK_STEP, end_time))
+    lons, lats, alts = overpass.orb.get_lonlatalt(np.array(times))
+    return lons, lats
+
+
+def find_covered_sectors(platform_name, start_time, end_time, threshold):
+    """Identify sectors with at least some coverage by a pass.
+
+    Parameters
+    ----------
+    platform_name : string
+    start_time, end_time : datetime.datetime
+        Time span of the pass.
+    threshold : float
+        Minimum fraction of the sector covered.
+
+    Returns
+    -------
+    list
+        AreaDefinition of each sector with coverage above the threshold.
+    """
+    key = (platform_name, start_time, end_time, threshold)
+    if key in _coverage_cache:
+        _coverage_cache.move_to_end(key)
+        return list(_coverage_cache[key])
+
+    overpass = Pass(platform_name, start_time, end_time, instrument="viirs")
+    logger.debug(f"Created overpass {overpass}")
+    logger.debug(f"args: {platform_name} :: {start_time} :: {end_time}")
+    lons, lats = ground_track(overpass, start_time, end_time)
+    candidates = get_sector_index().candidates(lons, lats, TRACK_REACH)
+    logger.debug("%d candidate sectors", len(candidates))
+
+    sectors = []
+    for sector_def in candidates:
+        logger.debug("Checking coverage for %s", sector_def.area_id)
+        coverage = overpass.area_coverage(sector_def)
+        logger.debug("{} coverage: {}".format(sector_def.area_id, coverage))
+        if coverage > threshold:
+            sectors.append(sector_def)
+
+    _coverage_cache[key] = sectors
+    while len(_coverage_cache) > COVERAGE_CACHE_SIZE:
+        _coverage_cache.popitem(last=False)
+
+    return list(sectors)
@@ -0,0 +1,251 @@
+"""
+Build sector images as SDR granules arrive.
+
+Rather than waiting for a whole pass to land, each granule is resampled into
+a canvas kept for every product and sector as soon as its files are in
+place. A sector is published when its coverage first reaches a step in
+COVERAGE_STEPS and again each time it passes another, so the first imagery
+of a sector goes out minutes before the pass is complete.
+
+"""
+
+import os
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+from satpy.scene import Scene
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor.budget import granule_times
+from avoviirsprocessor.catalog import find_files
+from avoviirsprocessor.metrics import metrics
+from avoviirsprocessor.runtime import get_runtime
+from avoviirsprocessor.processor import (
+    coverage_threshold,
+    build_processors,
+    publish_sector,
+)
+from avoviirsprocessor.sectors import find_covered_sectors
+from avoviirsprocessor.writer import get_writer
+
+COVERAGE_STEPS = sorted(
+    float(step)
+    for step in tutil.get_env_var("COVERAGE_STEPS", "0.25,0.5,0.75,1").split(",")
+)
+STREAM_POLL = float(tutil.get_env_var("STREAM_POLL", 10))
+STREAM_WAIT = timedelta(minutes=float(tutil.get_env_var("STREAM_WAIT", 20)))
+GRANULE_SETTLE = 5  # seconds a granule's files must be unchanged
+
+
+class SectorCanvas(object):
+    """One product's data for one sector, filled in granule by granule
+
+    Parameters
+    ----------
+    sector_def : pyresample.geometry.AreaDefinition
+    """
+
+    def __init__(self, sector_def):
+        self.sector_def = sector_def
+        self.data = None
+        self.coverage = 0.0
+        self.published = 0.0
+
+    def merge(self, local):
+        """Fill gaps in the canvas with newly resampled data.
+
+        Parameters
+        ----------
+        local : xarray.DataArray
+            Computed data resampled to the sector.
+        """
+        if self.data is None:
+            self.data = local.copy()
+        else:
+            values = self.data.values
+            gaps = np.isnan(values)
+            values[gaps] = local.values[gaps]
+
+        filled = np.isfinite(self.data.values)
+        if filled.ndim > 2:
+            filled = filled.any(axis=0)
+        self.coverage = float(filled.mean())
+
+    @property
+    def due(self):
+        """True if coverage has reached a step not yet published."""
+        return any(self.published < step <= self.coverage for step in COVERAGE_STEPS)
+
+
+class StreamingPass(object):
+    """Products from a single pass, built up as its granules arrive
+
+    Parameters
+    ----------
+    messages : list of posttroll.message.Message
+        Messages covering the same pass, one per product.
+    """
+
+    def __init__(self, messages):
+        self.data = messages[0].data
+        self.processors, self.failed = build_processors(messages, Scene)
+        for processor in self.processors:
+            processor.start_time = self.data["start_time"]
+        self.bands = sorted(set(b for p in self.processors for b in p.Bands))
+        self.sectors = find_covered_sectors(
+            self.data["platform_name"],
+            self.data["start_time"],
+            self.data["end_time"],
+            coverage_threshold(),
+        )
+        self.canvases = {}
+        self.granules = {}
+        self.latest = None
+
+    @property
+    def complete(self):
+        """True once a granule reaching the end of the pass has been processed."""
+        return self.latest is not None and self.latest >= self.data["end_time"]
+
+    def find_granules(self):
+        """Find granules of this pass which have finished arriving.
+
+        Returns
+        -------
+        dict
+            Lists of files keyed by granule start and end time.
+        """
+        filenames = find_files(
+            self.data["platform_name"], self.data["start_time"], self.data["end_time"]
+        )
+        granules = {}
+        for filename in filenames:
+            span = granule_times(filename)
+            if span is not None:
+                granules.setdefault(span, []).append(filename)
+
+        settled = time.time() - GRANULE_SETTLE
+        ready = {}
+        for span, filenames in granules.items():
+            try:
+                newest = max(os.path.getmtime(f) for f in filenames)
+            except OSError:
+                continue
+            if newest < settled:
+                ready[span] = sorted(filenames)
+        return ready
+
+    def poll(self):
+        """Process granules which have arrived since the last poll.
+
+        A granule which cannot be loaded is tried again if its files change.
+        """
+        for span, filenames in sorted(self.find_granules().items()):
+            if self.granules.get(span) == filenames:
+                continue
+            self.granules[span] = filenames
+            try:
+                self.add_granule(filenames)
+            except KeyError:
+                logger.info("Granule %s is incomplete, waiting for more files", span)
+                continue
+            if self.latest is None or span[1] > self.latest:
+                self.latest = span[1]
+
+    def add_granule(self, filenames):
+        """Resample a granule into every canvas, publishing sectors as they fill.
+
+        Parameters
+        ----------
+        filenames : list of string
+            SDR and geolocation files for the granule.
+        """
+        platform = self.data["platform_name"]
+        logger.debug("Adding granule %s", filenames[0])
+        scene = Scene(filenames=filenames, reader="viirs_sdr")
+        with metrics.timer("load_data", platform=platform):
+            scene.load(self.bands, generate=False)
+            for processor in self.processors:
+                processor.scene = scene
+                processor.load_data()
+
+        for sector_def in self.sectors:
+            for processor in self.processors:
+                if not processor.covers(sector_def):
+                    continue
+                with processor.timer("resample", sector_def.area_id):
+                    local = processor.resample_sector(sector_def).compute()
+                key = (processor.product, sector_def.area_id)
+                if key not in self.canvases:
+                    self.canvases[key] = SectorCanvas(sector_def)
+                canvas = self.canvases[key]
+                canvas.merge(local)
+                if canvas.due:
+                    self.publish(processor, canvas)
+
+    def publish(self, processor, canvas):
+        """Render and deliver a canvas as it stands.
+
+        Parameters
+        ----------
+        processor : processor.Processor
+        canvas : streaming.SectorCanvas
+        """
+        sector_def = canvas.sector_def
+        logger.info(
+            "Publishing %s %s at %.0f%% coverage",
+            processor.product,
+            sector_def.area_id,
+            canvas.coverage * 100,
+        )
+        pilimg = processor.draw_image(canvas.data, sector_def)
+        pngimg, outputs = processor.encode_outputs(pilimg, canvas.data, sector_def)
+        publish_sector(processor, sector_def, pngimg, outputs)
+        canvas.published = canvas.coverage
+
+    def finish(self):
+        """Publish every canvas which has grown since it was last published."""
+        for processor in self.processors:
+            for sector_def in self.sectors:
+                canvas = self.canvases.get((processor.product, sector_def.area_id))
+                if canvas is not None and canvas.coverage > canvas.published:
+                    self.publish(processor, canvas)
+
+
+def stream_pass(messages):
+    """Create and deliver products from a pass as its granules arrive.
+
+    Returns once the last granule of the pass has been processed, or
+    STREAM_WAIT after the pass ends, whichever comes first.
+
+    Parameters
+    ----------
+    messages : list of posttroll.message.Message
+        Messages covering the same pass, one per product.
+
+    Returns
+    -------
+    list
+        Messages which could not be processed.
+    """
+    stream = StreamingPass(messages)
+    if not stream.processors:
+        return stream.failed
+    notifier = get_runtime().notifier
+    writer = get_writer()
+    deadline = stream.data["end_time"] + STREAM_WAIT
+    while True:
+        stream.poll()
+        writer.flush()
+        notifier.flush()
+        if stream.complete or datetime.utcnow() > deadline:
+            break
+        time.sleep(STREAM_POLL)
+
+    stream.finish()
+    writer.flush()
+    notifier.flush()
+    metrics.write()
+    logger.debug("All done streaming this pass.")
+    return stream.failed
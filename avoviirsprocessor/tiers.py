@@ -0,0 +1,131 @@
+"""
+Derived outputs written next to each sector image.
+
+Downstream tools want smaller copies of each image, and the data behind it.
+Rather than have them decode and re-render the published PNG, a processor
+makes these outputs from the image and resampled data it already holds.
+The outputs made for a product are chosen by listing the product in
+HALF_SIZE_PRODUCTS, THUMBNAIL_PRODUCTS, or COG_PRODUCTS.
+
+"""
+
+import io
+
+import numpy as np
+from PIL import Image
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+
+HALF_SIZE_PRODUCTS = tutil.get_env_var("HALF_SIZE_PRODUCTS", "").split(",")
+THUMBNAIL_PRODUCTS = tutil.get_env_var("THUMBNAIL_PRODUCTS", "").split(",")
+COG_PRODUCTS = tutil.get_env_var("COG_PRODUCTS", "").split(",")
+THUMBNAIL_WIDTH = int(tutil.get_env_var("THUMBNAIL_WIDTH", 200))
+
+
+def _encode_png(pilimg, compress_level):
+    pngimg = io.BytesIO()
+    pilimg.save(pngimg, format="PNG", compress_level=compress_level)
+    return pngimg.getvalue()
+
+
+def half_size(pilimg, local, sector_def, compress_level):
+    """Encode the image at half size.
+
+    Parameters
+    ----------
+    pilimg : PIL.Image
+        Decorated sector image.
+    local : xarray.DataArray
+        Product data resampled to the sector.
+    sector_def : pyresample.geometry.AreaDefinition
+    compress_level : int
+        zlib compression level.
+
+    Returns
+    -------
+    bytes
+        PNG-encoded image.
+    """
+    width, height = pilimg.size
+    size = (max(1, width // 2), max(1, height // 2))
+    return _encode_png(pilimg.resize(size, Image.LANCZOS), compress_level)
+
+
+def thumbnail(pilimg, local, sector_def, compress_level):
+    """Encode the image THUMBNAIL_WIDTH pixels wide.
+
+    Parameters are as for half_size.
+
+    Returns
+    -------
+    bytes
+        PNG-encoded image.
+    """
+    width, height = pilimg.size
+    size = (THUMBNAIL_WIDTH, max(1, round(height * THUMBNAIL_WIDTH / width)))
+    return _encode_png(pilimg.resize(size, Image.LANCZOS), compress_level)
+
+
+def cloud_optimized_geotiff(pilimg, local, sector_def, compress_level):
+    """Encode the product data as a Cloud-Optimized GeoTIFF.
+
+    Values are written as float32, with missing data as NaN. This needs
+    rasterio, built with GDAL 3.1 or newer.
+
+    Parameters are as for half_size.
+
+    Returns
+    -------
+    bytes
+        GeoTIFF, or None if rasterio is not available.
+    """
+    try:
+        from rasterio.crs import CRS
+        from rasterio.io import MemoryFile
+        from rasterio.transform import from_bounds
+    except ImportError:
+        logger.error("rasterio is needed for Cloud-Optimized GeoTIFFs")
+        return None
+
+    data = np.asarray(local.values, dtype=np.float32)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    count, height, width = data.shape
+    with MemoryFile() as memfile:
+        with memfile.open(
+            driver="COG",
+            width=width,
+            height=height,
+            count=count,
+            dtype="float32",
+            crs=CRS.from_wkt(sector_def.crs.to_wkt()),
+            transform=from_bounds(*sector_def.area_extent, width, height),
+            nodata=np.nan,
+            compress="deflate",
+        ) as dataset:
+            dataset.write(data)
+        return memfile.read()
+
+
+TIERS = (
+    ("half.png", HALF_SIZE_PRODUCTS, half_size),
+    ("thumb.png", THUMBNAIL_PRODUCTS, thumbnail),
+    ("tif", COG_PRODUCTS, cloud_optimized_geotiff),
+)
+
+
+def tiers_for(product):
+    """List the extra outputs configured for a product.
+
+    Parameters
+    ----------
+    product : string
+
+    Returns
+    -------
+    list
+        filename suffix and encoding function for each output.
+    """
+    return [
+        (suffix, encode) for suffix, products, encode in TIERS if product in products
+    ]
@@ -0,0 +1,294 @@
+"""
+Deliver images to volcview.
+
+Uploads run in the background, one thread per volcview endpoint, so a slow
+endpoint delays neither rendering nor the other endpoints. Each thread holds
+a keep-alive session and retries failed uploads with exponential backoff.
+Uploads an endpoint has already acknowledged, according to the ledger, are
+not posted again. A callback can be given to learn when every endpoint is
+done with an image.
+
+"""
+
+import queue
+import threading
+import time
+
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+from avoviirsprocessor.ledger import get_ledger, upload_key
+from avoviirsprocessor.metrics import metrics
+
+POST_TIMEOUT = 30
+UPLOAD_QUEUE_SIZE = int(tutil.get_env_var("UPLOAD_QUEUE_SIZE", 50))
+UPLOAD_RETRIES = int(tutil.get_env_var("UPLOAD_RETRIES", 3))
+UPLOAD_BACKOFF = float(tutil.get_env_var("UPLOAD_BACKOFF", 2))
+UPLOAD_PATH = "/imageApi/uploadImage"
+RETRY_STATUS = (408, 429)  # client errors worth retrying
+
+
+class _Delivery(object):
+    # counts down the endpoints still working on an image
+    def __init__(self, endpoints, callback):
+        self._lock = threading.Lock()
+        self.remaining = endpoints
+        self.accepted = False
+        self.callback = callback
+
+    def done(self, accepted):
+        with self._lock:
+            self.accepted = self.accepted or accepted
+            self.remaining -= 1
+            if self.remaining:
+                return
+        try:
+            self.callback(self.accepted)
+        except Exception:
+            logger.exception("Delivery callback failed")
+
+
+class EndpointUploader(threading.Thread):
+    """Post images to a single volcview endpoint
+
+    Parameters
+    ----------
+    endpoint : string
+        Base URL of the volcview server.
+    headers : dict
+        HTTP headers sent with every request.
+    queue_size : int
+        Maximum number of images waiting to be posted.
+    retries : int
+        Number of times a failed upload is retried.
+    backoff : float
+        Seconds to wait before the first retry, doubled for each retry.
+    """
+
+    def __init__(self, endpoint, headers, queue_size, retries, backoff):
+        threading.Thread.__init__(self, daemon=True)
+        self.url = endpoint + UPLOAD_PATH
+        self.retries = retries
+        self.backoff = backoff
+        self.queue = queue.Queue(maxsize=queue_size)
+        # imported here so a worker can start without it, see runtime
+        import requests
+
+        self.request_error = requests.exceptions.RequestException
+        self.session = requests.Session()
+        self.session.headers.update(headers)
+        self.session.verify = False
+        self.delivered = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def run(self):
+        while True:
+            filename, pngbytes, volcview_args, key, delivery = self.queue.get()
+            accepted = False
+            try:
+                accepted = self.deliver(filename, pngbytes, volcview_args, key)
+            except Exception:
+                # keep the thread alive, or the queue fills and submit blocks
+                logger.exception("Cannot upload %s to %s", filename, self.url)
+                self.failed += 1
+            finally:
+                if delivery is not None:
+                    delivery.done(accepted)
+                self.queue.task_done()
+
+    def deliver(self, filename, pngbytes, volcview_args, key=None):
+        """Post an image unless the ledger shows it was already accepted.
+
+        Parameters are as for post.
+
+        Returns
+        -------
+        bool
+            True if the endpoint has accepted the image.
+        """
+        ledger = get_ledger() if key else None
+        if ledger and ledger.acknowledged(key, self.url):
+            logger.info("%s already accepted %s, skipping", self.url, filename)
+            self.skipped += 1
+            return True
+
+        response = self.post(filename, pngbytes, volcview_args, key)
+        return response is not None and response.ok
+
+    def post(self, filename, pngbytes, volcview_args, key=None):
+        """Post an image, retrying on failure.
+
+        Parameters
+        ----------
+        filename : string
+            Name of the image file.
+        pngbytes : bytes
+            PNG-encoded image.
+        volcview_args : dict
+            Form data describing the image.
+        key : string, optional
+            Upload key used to record acknowledgement in the ledger.
+
+        Returns
+        -------
+        requests.Response
+            The final response or None if every attempt failed.
+
+        Only a 2xx response counts as delivered. Other client errors are
+        not retried, as the same request would fail again.
+        """
+        ledger = get_ledger() if key else None
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            logger.info("publishing image to %s (attempt %d)", self.url, attempt + 1)
+            logger.debug("data %s", volcview_args)
+            try:
+                with metrics.timer(
+                    "upload",
+                    endpoint=self.url,
+                    sector=volcview_args["sector"],
+                    band=volcview_args["band"],
+                ) as timing:
+                    timing["bytes"] = len(pngbytes)
+                    response = self.session.post(
+                        self.url,
+                        data=volcview_args,
+                        files={"file": (filename, pngbytes)},
+                        timeout=POST_TIMEOUT,
+                    )
+                logger.info("server said: %s", response.text)
+                if 200 <= response.status_code < 300:
+                    self.delivered += 1
+                    if ledger:
+                        ledger.acknowledge(key, self.url)
+                    return response
+                if response.status_code < 500 and (
+                    response.status_code not in RETRY_STATUS
+                ):
+                    logger.error(
+                        "%s rejected %s: %d %s",
+                        self.url,
+                        filename,
+                        response.status_code,
+                        response.reason,
+                    )
+                    self.failed += 1
+                    return response
+                logger.info("Upload to %s failed: %d", self.url, response.status_code)
+            except self.request_error as e:
+                logger.info("Upload to %s failed: %s", self.url, e)
+
+        logger.error("Giving up on %s after %d attempts", filename, attempt + 1)
+        self.failed += 1
+        return None
+
+
+class Uploader(object):
+    """Post images to several volcview endpoints concurrently
+
+    Parameters
+    ----------
+    endpoints : list of string
+        Base URLs of the volcview servers.
+    user : string
+        volcview username.
+    passwd : string
+        volcview password.
+    queue_size : int, optional
+        Maximum number of images waiting for each endpoint. Submitting an
+        image blocks while any endpoint's queue is full.
+    retries : int, optional
+        Number of times a failed upload is retried.
+    backoff : float, optional
+        Seconds to wait before the first retry, doubled for each retry.
+    """
+
+    def __init__(
+        self,
+        endpoints,
+        user,
+        passwd,
+        queue_size=UPLOAD_QUEUE_SIZE,
+        retries=UPLOAD_RETRIES,
+        backoff=UPLOAD_BACKOFF,
+    ):
+        headers = {"username": user, "password": passwd}
+        self.endpoints = [
+            EndpointUploader(endpoint, headers, queue_size, retries, backoff)
+            for endpoint in endpoints
+        ]
+        for endpoint in self.endpoints:
+            endpoint.start()
+
+    def submit(self, filename, pngbytes, volcview_args, callback=None):
+        """Queue an image for delivery to every endpoint.
+
+        Parameters
+        ----------
+        filename : string
+            Name of the image file.
+        pngbytes : bytes
+            PNG-encoded image.
+        volcview_args : dict
+            Form data describing the image.
+        callback : callable, optional
+            Called, on an uploader thread, once every endpoint has posted
+            the image or given up. It is passed True if any endpoint
+            accepted the image.
+        """
+        logger.debug("image size %d", len(pngbytes))
+        key = upload_key(pngbytes, volcview_args) if get_ledger() else None
+        delivery = None
+        if callback is not None:
+            if not self.endpoints:
+                callback(False)
+                return
+            delivery = _Delivery(len(self.endpoints), callback)
+        for endpoint in self.endpoints:
+            endpoint.queue.put((filename, pngbytes, volcview_args, key, delivery))
+
+    def pending(self):
+        """Count images waiting to be posted, summed over all endpoints."""
+        return sum(endpoint.queue.unfinished_tasks for endpoint in self.endpoints)
+
+    def join(self):
+        """Block until every queued image has been posted or abandoned."""
+        for endpoint in self.endpoints:
+            endpoint.queue.join()
+
+
+_uploader = None
+_uploader_lock = threading.Lock()
+
+
+def get_uploader():
+    """Return the uploader shared by this process, creating it if needed.
+
+    Returns
+    -------
+    uploader.Uploader
+    """
+    global _uploader
+
+    with _uploader_lock:
+        if _uploader is None:
+            _uploader = Uploader(
+                tutil.get_env_var("VV_ENDPOINTS").split(","),
+                tutil.get_env_var("VOLCVIEW_USER"),
+                tutil.get_env_var("VOLCVIEW_PASSWD", secret=True),
+            )
+    return _uploader
+
+
+def pending():
+    """Count images queued by this process and not yet delivered."""
+    if _uploader is None:
+        return 0
+    return _uploader.pending()
+
+
+def drain():
+    """Block until images queued by this process have been delivered."""
+    if _uploader is not None:
+        _uploader.join()
@@ -0,0 +1,203 @@
+"""
+Write output files without holding up rendering.
+
+Image files go to a network mount, where every write can stall. Writes are
+queued to a small pool of I/O threads, so rendering continues while they
+complete. Each file is written under a temporary name, synced, and renamed
+into place, so neither readers nor a crash can leave a partial file at the
+final name. Rather than syncing a directory after every rename, the
+directories written to are synced together when a pass is flushed.
+
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import tomputils.util as tutil
+from avoviirsprocessor import logger
+
+OUTPUT_WORKERS = int(tutil.get_env_var("OUTPUT_WORKERS", 4))
+
+
+def write_file(filename, data):
+    """Write a file so it is never seen partially written.
+
+    The data is synced to disk before the file is renamed into place. The
+    rename itself is durable once the directory is synced.
+
+    Parameters
+    ----------
+    filename : string
+    data : bytes-like
+    """
+    tmp_filename = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+    with open(tmp_filename, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+def link_file(src, filename):
+    """Hard link a file into place.
+
+    The link is durable once the directory is synced.
+
+    Parameters
+    ----------
+    src : string
+        Existing file.
+    filename : string
+        New name for the file.
+    """
+    tmp_filename = "{}.{}.{}.tmp".format(filename, os.getpid(), threading.get_ident())
+    os.link(src, tmp_filename)
+    os.replace(tmp_filename, filename)
+
+
+def _fsync_dir(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        # removed since it was written to
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        # some filesystems cannot sync a directory
+        pass
+    finally:
+        os.close(fd)
+
+
+class OutputWriter(object):
+    """Queue of file writes run on a pool of I/O threads
+
+    Parameters
+    ----------
+    workers : int
+        Number of I/O threads.
+    """
+
+    def __init__(self, workers=OUTPUT_WORKERS):
+        self.workers = workers
+        self._lock = threading.Lock()
+        self._pool = None
+        self._pid = None
+        self._futures = []
+        self._written = []
+        self._dirs = set()
+
+    def _get_pool(self):
+        # threads do not survive a fork
+        if self._pool is None or self._pid != os.getpid():
+            self._pool = ThreadPoolExecutor(self.workers)
+            self._pid = os.getpid()
+            self._futures = []
+            self._written = []
+        return self._pool
+
+    def submit(self, func, *args):
+        """Run a function on an I/O thread.
+
+        Parameters
+        ----------
+        func : callable
+            Function writing files through this writer.
+        args
+            Arguments for func.
+        """
+        with self._lock:
+            future = self._get_pool().submit(func, *args)
+            self._futures.append(future)
+
+    def pending(self):
+        """Return the number of submitted functions not yet finished."""
+        with self._lock:
+            return sum(not future.done() for future in self._futures)
+
+    def make_dirs(self, path):
+        """Create a directory and its parents, once per process.
+
+        Parameters
+        ----------
+        path : string
+        """
+        if path in self._dirs:
+            return
+        try:
+            os.makedirs(path, exist_ok=True)
+        except OSError:
+            logger.exception("Cannot create %s", path)
+            return
+        self._dirs.add(path)
+
+    def write(self, filename, data):
+        """Write a file atomically, syncing its directory on the next flush.
+
+        Parameters
+        ----------
+        filename : string
+        data : bytes-like
+        """
+        write_file(filename, data)
+        with self._lock:
+            self._written.append(filename)
+
+    def link(self, src, filename):
+        """Hard link a file into place, syncing its directory on the next flush.
+
+        Parameters
+        ----------
+        src : string
+            Existing file.
+        filename : string
+            New name for the file.
+        """
+        link_file(src, filename)
+        with self._lock:
+            self._written.append(filename)
+
+    def flush(self):
+        """Wait for queued writes, then sync the directories written to.
+
+        Returns
+        -------
+        int
+            Number of submitted functions which failed.
+        """
+        with self._lock:
+            futures, self._futures = self._futures, []
+        failed = 0
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                logger.exception("Cannot write output")
+                failed += 1
+
+        with self._lock:
+            written, self._written = self._written, []
+        directories = sorted(set(os.path.dirname(f) for f in written))
+        list(self._get_pool().map(_fsync_dir, directories))
+        return failed
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Return the output writer shared by this process, creating it if needed.
+
+    Returns
+    -------
+    writer.OutputWriter
+    """
+    global _writer
+
+    with _writer_lock:
+        if _writer is None:
+            _writer = OutputWriter()
+    return _writer
@@ -26,8 +26,9 @@ setup(
     install_requires=["tomputils>=1.12.16"],
     entry_points={
         "console_scripts": [
-            "process_message = avoviirsprocessor.process_message:main",
+            "process_message = avoviirsprocessor.launcher:process_message",
             "healthcheck = avoviirsprocessor.healthcheck:main",
+            "benchmark = avoviirsprocessor.launcher:benchmark",
         ]
     },
 )
@@ -15,91 +15,214 @@
 import zmq
 import time
 import signal
-import threading
 
 from posttroll.message import Message, MessageError
-from avoviirsprocessor.processor import publish_products
+from avoviirsprocessor import budget
 from avoviirsprocessor import logger
-from avoviirsprocessor.coreprocessors import TIR, MIR, BTD, VIS  # NOQA
+from avoviirsprocessor.runtime import get_runtime
+from avoviirsprocessor import metrics
+from avoviirsprocessor.health import health
 import tomputils.util as tutil
 from pathlib import Path
 
 HEARTBEAT_FILE = "/tmp/heartbeat"
 
+POLL_INTERVAL = 1000
 REQUEST_TIMEOUT = 10000
+NO_JOB_BACKOFF = 1
+TASK_BATCH_SIZE = int(tutil.get_env_var("TASK_BATCH_SIZE", 1))
+STREAMING = tutil.get_env_var("STREAMING", "false").lower() == "true"
 TASK_SERVER = "tcp://viirscollector:19091"
 UPDATE_PUBLISHER = "tcp://viirscollector:19191"
 
 
-class UpdateSubscriber(threading.Thread):
-    def __init__(self, context):
-        threading.Thread.__init__(self)
-        self.socket = context.socket(zmq.SUB)
-        self.socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
-        self.socket.setsockopt(zmq.TCP_KEEPALIVE_IDLE, 60)
-        self.socket.setsockopt(zmq.TCP_KEEPALIVE_CNT, 20)
-        self.socket.setsockopt(zmq.TCP_KEEPALIVE_INTVL, 60)
-        self.socket.setsockopt_string(zmq.SUBSCRIBE, "")
-        self.socket.connect(UPDATE_PUBLISHER)
-        self.task_waiting = False
-        self.queue_length = None
+def subscribe_updates(context):
+    socket = context.socket(zmq.SUB)
+    socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
+    socket.setsockopt(zmq.TCP_KEEPALIVE_IDLE, 60)
+    socket.setsockopt(zmq.TCP_KEEPALIVE_CNT, 20)
+    socket.setsockopt(zmq.TCP_KEEPALIVE_INTVL, 60)
+    socket.setsockopt_string(zmq.SUBSCRIBE, "")
+    socket.connect(UPDATE_PUBLISHER)
+    return socket
 
-    def run(self):
-        while True:
-            update = self.socket.recv_json()
-            self.task_waiting = update["queue length"] > 0
-            self.queue_length = update["queue length"]
+
+def read_queue_length(socket):
+    """Read every waiting update and return the most recent queue length."""
+    queue_length = None
+    while True:
+        try:
+            update = socket.recv_json(zmq.NOBLOCK)
+        except zmq.Again:
+            return queue_length
+        queue_length = update["queue length"]
+
+
+class TaskClient(object):
+    """Request tasks, recovering from lost replies.
+
+    A REQ socket which never receives a reply cannot send again, so if
+    a reply does not arrive within REQUEST_TIMEOUT the socket is discarded
+    and a new one connected.
+    """
+
+    def __init__(self, context, poller, desired_products):
+        self.context = context
+        self.poller = poller
+        self.request = {"desired products": desired_products}
+        self.socket = None
+        self.sent_at = None
+        self._connect()
+
+    def _connect(self):
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(TASK_SERVER)
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.sent_at = None
+
+    @property
+    def outstanding(self):
+        return self.sent_at is not None
+
+    def send(self):
+        self.socket.send_json(self.request)
+        self.sent_at = time.time()
+
+    def recv(self):
+        self.sent_at = None
+        return self.socket.recv()
+
+    def expired(self):
+        return (
+            self.outstanding and (time.time() - self.sent_at) * 1000 > REQUEST_TIMEOUT
+        )
+
+    def reset(self):
+        logger.info("No reply from task server, reconnecting.")
+        self.poller.unregister(self.socket)
+        self.socket.close()
+        self._connect()
+
+
+def decode_messages(msgs_bytes):
+    messages = []
+    for msg_bytes in msgs_bytes:
+        try:
+            messages.append(Message.decode(msg_bytes))
+        except MessageError:
+            logger.exception("Message decode error.")
+    return messages
+
+
+def process_messages(msgs_bytes, queue_length):
+    # the processing stack is imported on first use, see Runtime.prewarm
+    from avoviirsprocessor.processor import group_messages
+
+    messages = decode_messages(msgs_bytes)
+    try:
+        passes = group_messages(messages)
+    except KeyError:
+        logger.exception("Cannot group messages, processing them one at a time.")
+        passes = [[message] for message in messages]
+
+    for messages in passes:
+        process_pass(messages)
+
+    get_runtime().rest(queue_length)
 
 
-def process_message(msg_bytes):
+def process_pass(messages):
+    from avoviirsprocessor.coreprocessors import TIR, MIR, BTD, VIS  # NOQA
+    from avoviirsprocessor.processor import publish_pass
+    from avoviirsprocessor.streaming import stream_pass
+
+    start = time.time()
+    success = False
+    failed = []
     try:
-        message = Message.decode(msg_bytes)
-        publish_products(message)
-    except MessageError:
-        logger.exception("Message decode error.")
+        if STREAMING:
+            failed = stream_pass(messages)
+        else:
+            failed = publish_pass(messages)
+        success = True
     except NotImplementedError:
         logger.exception("Crap. I accepted a message I can't process.")
     except ValueError:
         logger.exception("I got a message, but couldn't find the data")
     except KeyError:
         logger.exception("missing data, skipping")
-
-    logger.debug("Whew, that was hard. Let rest for 10 seconds.")
-    time.sleep(10)
+    end_times = [m.data["end_time"] for m in messages if "end_time" in m.data]
+    data_time = max(end_times) if end_times else None
+    elapsed = time.time() - start
+    done = len(messages) - len(failed)
+    if done:
+        health.task_done(done, elapsed, data_time, success)
+    if failed:
+        health.task_done(len(failed), elapsed, data_time, success=False)
 
 
 def main():
     # let ctrl-c work as it should.
     signal.signal(signal.SIGINT, signal.SIG_DFL)
 
-    context = zmq.Context()
-    logger.debug("starting update_subscriber")
-    update_subscriber = UpdateSubscriber(context)
-    update_subscriber.start()
-    logger.debug("started update_subscriber")
-
-    task_client = context.socket(zmq.REQ)
-    task_client.connect(TASK_SERVER)
+    # before the processing stack, and satpy, are imported; see budget
+    budget.configure()
+    context = zmq.Context.instance()
+    runtime = get_runtime(context)
+    metrics.serve()
+    health.start()
+    poller = zmq.Poller()
+    updates = subscribe_updates(context)
+    poller.register(updates, zmq.POLLIN)
 
     desired_products = tutil.get_env_var("VIIRS_PRODUCTS")
     desired_products = desired_products.split(",")
+    task_client = TaskClient(context, poller, desired_products)
+    runtime.prewarm()
 
+    queue_length = 0
+    next_request = 0
+    tasks = []
     while True:
-        logger.debug("beating heart")
         Path(HEARTBEAT_FILE).touch()
-        if update_subscriber.task_waiting:
-            request = {"desired products": desired_products}
-            task_client.send_json(request)
+        health.set_stage("waiting")
+        may_request = (
+            queue_length
+            and not task_client.outstanding
+            and time.time() >= next_request
+        )
+        if may_request and len(tasks) < TASK_BATCH_SIZE:
+            task_client.send()
+
+        events = dict(poller.poll(POLL_INTERVAL))
+        if updates in events:
+            latest = read_queue_length(updates)
+            if latest is not None:
+                queue_length = latest
+                health.queue_length(queue_length)
+                logger.debug("Queue length: %s", queue_length)
+
+        if task_client.socket in events:
             msg_bytes = task_client.recv()
             if msg_bytes:
-                process_message(msg_bytes)
+                tasks.append(msg_bytes)
             else:
                 logger.debug("No job received")
-                time.sleep(1)
-            logger.debug("tomp says 4")
-        else:
-            logger.debug("Queue empty")
-            time.sleep(5)
+                next_request = time.time() + NO_JOB_BACKOFF
+        elif task_client.expired():
+            task_client.reset()
+
+        if not tasks or task_client.outstanding:
+            continue
+
+        dry = time.time() < next_request
+        if len(tasks) >= TASK_BATCH_SIZE or not queue_length or dry:
+            if queue_length and not dry:
+                # prefetch the next task while this batch renders
+                task_client.send()
+            process_messages(tasks, queue_length)
+            tasks = []
 
 
 if __name__ == "__main__":